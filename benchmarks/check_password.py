@@ -0,0 +1,52 @@
+#!/usr/bin/env python2
+"""Measures the latency of a login (Tutor.check_password) for several
+PBKDF2 costs, to choose "password_iterations", and compares it with
+legacy hashes."""
+import time
+import sqlite3
+
+import enseigner.model as model
+from enseigner.config import config
+
+NB_LOGINS = 20
+ITERATIONS = (10000, 50000, 100000, 200000)
+
+def measure(email, password):
+    start = time.time()
+    for i in xrange(NB_LOGINS):
+        assert model.Tutor.check_password(email, password)
+    return (time.time() - start) / NB_LOGINS
+
+def main():
+    db = sqlite3.connect(':memory:')
+    db.execute(model.Tutor._create_table)
+    model.get_conn = lambda: db
+
+    tutor = model.Tutor.create('legacy@example.org', 'Legacy')
+    legacy_hash = model.legacy_password_hash(tutor.uid, 'password')
+    def legacy():
+        # What check_password used to do: two queries, hash compared in SQL
+        c = db.cursor()
+        c.execute('SELECT tutor_id FROM tutors WHERE tutor_email=?',
+                  ('legacy@example.org',))
+        tutor_id = c.fetchone()[0]
+        c.execute('''SELECT * FROM tutors
+                     WHERE tutor_id=? AND tutor_password_hash=?''',
+                  (tutor_id, model.legacy_password_hash(tutor_id, 'password')))
+        assert c.fetchone()
+    db.execute('UPDATE tutors SET tutor_password_hash=?', (legacy_hash,))
+    start = time.time()
+    for i in xrange(NB_LOGINS):
+        legacy()
+    print('%-20s %.2f ms per login' % ('legacy sha512',
+            (time.time() - start) / NB_LOGINS * 1000))
+
+    for iterations in ITERATIONS:
+        config['password_iterations'] = iterations
+        email = 'tutor%d@example.org' % iterations
+        model.Tutor.create(email, 'Tutor', 'password')
+        print('%-20s %.2f ms per login' % ('pbkdf2 %d' % iterations,
+                measure(email, 'password') * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python2
+# -*- coding: utf8 -*-
+"""Measures how fast a mailing of NB_MAILS mails is inserted in an
+on-disk database, and the size of the database."""
+import os
+import time
+import shutil
+import tempfile
+
+import enseigner.model as model
+
+NB_MAILS = 10000
+CONTENT = u'''Bonjour %d,
+
+Voici, comme chaque semaine, le lien vers le formulaire pour participer à
+la séance de samedi prochain en tant que tuteur-trice.
+'''
+
+def rows():
+    for i in xrange(NB_MAILS):
+        yield (u'tutor%d@example.org' % i, u'Séance', CONTENT % i)
+
+def one_by_one():
+    # What Mail.create_many used to do, building the same instances
+    conn = model.get_conn()
+    c = conn.cursor()
+    r = []
+    for args in rows():
+        args += (False, 0, None, None, None, None, None)
+        c.execute('INSERT INTO mails (%s) VALUES (%s)' %
+                  (model.Mail._columns, ', '.join('?'*len(args))), args)
+        r.append(model.Mail._from_row((c.lastrowid,) + args))
+    conn.commit()
+    c.close()
+    assert len(r) == NB_MAILS
+
+def create_many():
+    assert len(model.Mail.create_many(rows())) == NB_MAILS
+
+def create_many_no_load():
+    assert model.Mail.create_many(rows(), load=False) == NB_MAILS
+
+def create_for_mailing():
+    mailing = model.Mailing.create(u'Séance', CONTENT.replace('%d', '$nom'),
+                                   ['nom'])
+    rows = ((u'tutor%d@example.org' % i, {'nom': i})
+            for i in xrange(NB_MAILS))
+    assert model.Mail.create_for_mailing(mailing, rows, load=False) == NB_MAILS
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for f in (one_by_one, create_many, create_many_no_load,
+                  create_for_mailing):
+            path = os.path.join(tmpdir, f.__name__ + '.sqlite3')
+            model.pool = model.ConnectionPool(path,
+                    pragmas=model.DEFAULT_PRAGMAS)
+            with model.get_conn() as conn:
+                conn.execute(model.Mailing._create_table)
+                conn.execute(model.Mail._create_table)
+            start = time.time()
+            f()
+            duration = time.time() - start
+            model.pool.close()
+            print('%-20s %d mails in %.3fs: %d mails/s, %d kB' %
+                    (f.__name__, NB_MAILS, duration, NB_MAILS / duration,
+                     os.path.getsize(path) // 1024))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
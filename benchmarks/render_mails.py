@@ -0,0 +1,61 @@
+#!/usr/bin/env python2
+# -*- coding: utf8 -*-
+"""Measures how fast the mails of a mailing to NB_MAILS tutors are
+rendered and encoded."""
+import time
+import string
+from email.mime.text import MIMEText
+
+import enseigner.emails as emails
+import enseigner.mailmerge as mailmerge
+from enseigner.controller import TUTOR_EMAIL_VARIABLES
+
+NB_MAILS = 10000
+SUBJECT = u'ENSeigner — Participation à la séance du 28/12/2014'
+CONTENT = u'''Bonjour $nom_tuteur,
+
+Voici, comme chaque semaine, le lien vers le formulaire pour participer à
+la séance de samedi prochain en tant que tuteur-trice :
+$lien_formulaire_tuteur
+
+Cordialement,
+Les reponsables du soutien'''
+EMAIL_CONFIG = {'from': 'soutien@example.org', 'bcc': 'soutien@example.org'}
+
+def recipients():
+    for i in xrange(NB_MAILS):
+        yield (u'tutor%d@example.org' % i, {
+            'nom_tuteur': u'Tuteur %d' % i,
+            'lien_formulaire_tuteur':
+                u'https://example.org/formulaires/tuteur/?tuteur=%d' % i,
+            })
+
+def string_template():
+    # What send_tutor_email and Sender.send used to do
+    for (recipient, repl) in recipients():
+        subject = string.Template(SUBJECT).substitute(repl)
+        content = string.Template(CONTENT).substitute(repl)
+        msg = MIMEText(content, _charset='utf8')
+        msg['Subject'] = subject
+        msg['From'] = EMAIL_CONFIG['from']
+        msg['To'] = recipient
+        msg['Bcc'] = EMAIL_CONFIG['bcc']
+        msg.as_string()
+
+def mail_template():
+    template = mailmerge.MailTemplate(SUBJECT, CONTENT, TUTOR_EMAIL_VARIABLES)
+    sender = emails.SMTPSender(EMAIL_CONFIG)
+    for (recipient, repl) in recipients():
+        (subject, content) = template.render(repl)
+        sender.format(recipient, subject, content)
+
+def main():
+    for f in (string_template, mail_template):
+        start = time.time()
+        f()
+        duration = time.time() - start
+        print('%-20s %d mails in %.3fs: %d mails/s' %
+                (f.__name__, NB_MAILS, duration, NB_MAILS / duration))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python2
+"""Compares the generation and the verification of subscription link
+signatures: the legacy SHA-256 of the secret and the parameters, and
+LinkSigner's HMAC, one by one and for a whole mailing."""
+import time
+
+import enseigner.signing as signing
+from enseigner.config import config
+
+NB_LINKS = 10000
+
+def measure(name, f):
+    start = time.time()
+    f()
+    print('%-20s %.0f links/s' % (name, NB_LINKS / (time.time() - start)))
+
+def main():
+    secret = config['secret_key']
+    signer = signing.LinkSigner(secret)
+    user_ids = range(NB_LINKS)
+    measure('legacy', lambda: [signing.legacy_signature(secret, 1, 'tutor', x)
+                               for x in user_ids])
+    measure('sign', lambda: [signer.sign(1, 'tutor', x) for x in user_ids])
+    measure('sign_many', lambda: signer.sign_many(1, 'tutor', user_ids))
+    tokens = signer.sign_many(1, 'tutor', user_ids)
+    measure('verify', lambda: [signer.verify(tokens[x], 1, 'tutor', x)
+                               for x in user_ids])
+    tokens = {x: signing.legacy_signature(secret, 1, 'tutor', x)
+              for x in user_ids}
+    measure('verify legacy', lambda: [signer.verify(tokens[x], 1, 'tutor', x)
+                                      for x in user_ids])
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,13 @@
+# -*- coding: utf8 -*-
 import csv
-import string
-import smtplib
-import hashlib
+import time
 import datetime
 import operator
+import itertools
 import collections
 
 import model
-import emails
+import signing
 from config import config
 
 TutorForm = collections.namedtuple('TutorForm',
@@ -17,16 +17,20 @@ StudentForm = collections.namedtuple('StudentForm',
 
 class WrongHash(Exception):
     pass
+link_signer = signing.LinkSigner(config['secret_key'],
+        config.get('accept_legacy_links', True))
+def link_expiry():
+    """Returns the expiry date of new links, from the
+    "subscription_link_lifetime" setting (in seconds; no expiry if
+    unset)."""
+    lifetime = config.get('subscription_link_lifetime')
+    return None if lifetime is None else time.time() + lifetime
 def hash_subscription_params(session_id, type_, user_id):
-    salt = config['secret_key']
-    assert len(salt) >= 20, 'Secret is not long enough'
-    assert type_ in ('tutor', 'student'), type_
-    return hashlib.sha256('%s|%s|%s|%s' % (salt, type_, session_id, user_id))\
-            .hexdigest()
+    return link_signer.sign(session_id, type_, user_id, link_expiry())
 def check_hash(type_):
     def decorator(f):
         def newf(session_id, user_id, hash_, *args):
-            if hash_subscription_params(session_id, type_, user_id) != hash_:
+            if not link_signer.verify(hash_, session_id, type_, user_id):
                 raise WrongHash()
             return f(session_id, user_id, *args)
         return newf
@@ -35,23 +39,31 @@ def check_hash(type_):
 def parse_human_date(date):
     return datetime.datetime.strptime(date, "%d/%m/%Y %H:%M")
 
+def parse_human_day(date):
+    return datetime.datetime.strptime(date, "%d/%m/%Y")
+
 def create_session(date, exceptional_subjects_names):
     date = parse_human_date(date)
-    session = model.Session.create(date, '', False, False)
-    subjects = list(model.Subject.all_permanent())
-    for subject in exceptional_subjects_names:
-        subjects.append(model.Subject.create(subject, True))
-    model.SessionSubject.create_for_session(session, subjects)
+    with model.transaction():
+        session = model.Session.create(date, '', False, False)
+        subjects = list(model.Subject.all_permanent())
+        for subject in exceptional_subjects_names:
+            subjects.append(model.Subject.create(subject, True))
+        model.SessionSubject.create_for_session(session, subjects)
     return session
 
 def get_tutor_registration_list_rows(session):
     Row = collections.namedtuple('Row', 'tutor subjects1 subjects2 comment')
     tregs = model.TutorRegistration.all_in_session(session)
+    tutors = {x.uid: x for x in model.Tutor.all_in_session(session)}
+    tregs_subjects = collections.defaultdict(list)
+    for x in model.TutorRegistrationSubject.all_in_session(session):
+        tregs_subjects[x.trid].append(x)
     rows = []
     for treg in tregs:
-        subjects = model.TutorRegistrationSubject.all_of_treg(treg)
+        subjects = tregs_subjects[treg.trid]
         rows.append(Row(
-            model.Tutor.get(treg.uid),
+            tutors[treg.uid],
             [model.Subject.get(x.sid) for x in subjects if x.preference == 1],
             [model.Subject.get(x.sid) for x in subjects if x.preference == 2],
             treg.comment
@@ -64,6 +76,89 @@ def get_tutor_registration_list_rows(session):
     rows.sort(key=key)
     return rows
 
+TUTOR_REGISTRATION_LIST_HEADERS = ('Nom', 'Email', u'Matière principale',
+        u'Autres matières', 'Commentaire', 'Confirmation')
+
+def tutor_registration_list_cells(rows):
+    """Yields the cells of an export of the list of registered tutors,
+    starting with the headers."""
+    yield TUTOR_REGISTRATION_LIST_HEADERS
+    for row in rows:
+        yield (row.tutor.name,
+               row.tutor.email,
+               ', '.join(x.name for x in row.subjects1),
+               ', '.join(x.name for x in row.subjects2),
+               row.comment)
+
+def export_sessions(start, end):
+    """Returns the sheets, as (name, rows) pairs, of an export of the
+    sessions whose date is in [start, end[, their registrations, and the
+    tutors, students, and subjects involved.
+
+    The data is loaded by a fixed number of queries, from a snapshot of
+    the database, whatever the number of sessions; the rows are generated
+    lazily."""
+    with model.transaction(snapshot=True):
+        sessions = model.Session.all_between(start, end)
+        tregs = model.TutorRegistration.all_between(start, end)
+        tregs_subjects = collections.defaultdict(list)
+        for x in model.TutorRegistrationSubject.all_between(start, end):
+            tregs_subjects[x.trid].append(x)
+        sregs = model.StudentRegistration.all_between(start, end)
+        tutors = {x.uid: x for x in model.Tutor.all_registered_between(start, end)}
+        students = {x.uid: x for x in model.Student.all_registered_between(start, end)}
+        # Not from the catalog, which can miss recent subjects
+        subjects = {x.sid: x for x in model.Subject.all(cached=False)}
+    dates = {x.sid: x.date for x in sessions}
+    def by_session(regs, session_key, person_key, persons):
+        return sorted(regs, key=lambda x: (dates[getattr(x, session_key)],
+                                           persons[getattr(x, person_key)].name))
+    def names(tregs_subjects, preference):
+        return ', '.join(sorted(subjects[x.sid].name for x in tregs_subjects
+                                if x.preference == preference))
+
+    def sessions_rows():
+        nb_tutors = collections.Counter(x.sid for x in tregs)
+        nb_students = collections.Counter(x.seid for x in sregs)
+        yield ('Date', 'Tuteurs', u'Élèves')
+        for session in sessions:
+            yield (session.date, nb_tutors[session.sid],
+                   nb_students[session.sid])
+    def subjects_rows():
+        yield ('Nom', 'Exceptionnelle')
+        for subject in sorted(subjects.values(), key=lambda x: x.sid):
+            yield (subject.name, subject.is_exceptional)
+    def tutors_rows():
+        yield ('Nom', 'Email', u'Téléphone', 'Commentaire')
+        for tutor in sorted(tutors.values(), key=lambda x: x.name):
+            yield (tutor.name, tutor.email, tutor.phone_number, tutor.comment)
+    def tregs_rows():
+        yield ('Date', 'Nom', 'Email', u'Matière principale',
+               u'Autres matières', 'Taille de groupe', 'Commentaire')
+        for treg in by_session(tregs, 'sid', 'uid', tutors):
+            tutor = tutors[treg.uid]
+            yield (dates[treg.sid], tutor.name, tutor.email,
+                   names(tregs_subjects[treg.trid], 1),
+                   names(tregs_subjects[treg.trid], 2),
+                   treg.group_size, treg.comment)
+    def students_rows():
+        yield ('Nom', 'Emails', u'Téléphone', 'Commentaire')
+        for student in sorted(students.values(), key=lambda x: x.name):
+            yield (student.name, student.emails, student.phone_number,
+                   student.comment)
+    def sregs_rows():
+        yield ('Date', 'Nom', u'Matière', 'Amis', 'Commentaire')
+        for sreg in by_session(sregs, 'seid', 'stid', students):
+            yield (dates[sreg.seid], students[sreg.stid].name,
+                   subjects[sreg.suid].name, sreg.friends, sreg.comment)
+
+    return [(u'Séances', sessions_rows()),
+            (u'Matières', subjects_rows()),
+            (u'Tuteurs', tutors_rows()),
+            (u'Inscriptions tuteurs', tregs_rows()),
+            (u'Élèves', students_rows()),
+            (u'Inscriptions élèves', sregs_rows())]
+
 @check_hash('tutor')
 def get_tutor_form_data(session, tutor):
     tutor = model.Tutor.get(int(tutor))
@@ -81,14 +176,15 @@ def get_tutor_form_data(session, tutor):
 
 @check_hash('tutor')
 def set_tutor_form_data(session, tutor, subjects, group_size, comment):
-    try:
-        treg = model.TutorRegistration.find(int(session), int(tutor))
-    except model.NotFound:
-        treg = model.TutorRegistration.create(int(session), int(tutor), group_size, comment)
-    else:
-        treg.update(group_size, comment)
-    model.TutorRegistrationSubject.set_for_treg(treg,
-            ((model.Subject.get(int(x)), y) for (x,y) in subjects))
+    with model.transaction():
+        try:
+            treg = model.TutorRegistration.find(int(session), int(tutor))
+        except model.NotFound:
+            treg = model.TutorRegistration.create(int(session), int(tutor), group_size, comment)
+        else:
+            treg.update(group_size, comment)
+        model.TutorRegistrationSubject.set_for_treg(treg,
+                ((model.Subject.get(int(x)), y) for (x,y) in subjects))
     return treg
 
 @check_hash('student')
@@ -112,59 +208,77 @@ def set_student_form_data(session, student, subject, friends, comment):
     student = int(student)
     subject = model.Subject.get(int(subject))
     friends = int(friends)
-    try:
-        sreg = model.StudentRegistration.find(session, student)
-    except model.NotFound:
-        sreg = model.StudentRegistration.create(session, student,
-                subject, friends, comment)
-    else:
-        sreg.update(subject, friends, comment)
+    with model.transaction():
+        try:
+            sreg = model.StudentRegistration.find(session, student)
+        except model.NotFound:
+            sreg = model.StudentRegistration.create(session, student,
+                    subject, friends, comment)
+        else:
+            sreg.update(subject, friends, comment)
     return sreg
 
+TUTOR_EMAIL_VARIABLES = ('nom_tuteur', 'lien_formulaire_tuteur')
+
 def send_tutor_email(session, get_form_url, subject, content):
+    """Queues a mail to every active tutor, and returns their number.
+    They are sent by the mailqueue worker. `get_form_url(tutor, key)`
+    returns the URL of the tutor's form.
+
+    Raises mailmerge.TemplateError before queuing anything if the subject
+    or the content is not a valid template."""
     tutors = model.Tutor.all_active()
+    keys = link_signer.sign_many(session.sid, 'tutor',
+                                 [x.uid for x in tutors], link_expiry())
     def pred(tutor):
         repl = {'nom_tuteur': tutor.name,
-                'lien_formulaire_tuteur': get_form_url(tutor)
+                'lien_formulaire_tuteur': get_form_url(tutor, keys[tutor.uid])
                 }
-        return (tutor.email,
-                string.Template(subject).substitute(repl),
-                string.Template(content).substitute(repl)
-                )
-    mails = model.Mail.create_many(map(pred, tutors))
-    sender = emails.Sender()
-    errors = []
-    for mail in mails:
-        try:
-            sender.send(mail.recipient, mail.subject, mail.content)
-        except smtplib.SMTPException as e:
-            errors.append((mail, e))
-        else:
-            mail.set_sent()
-    session.set_emailed_tutors()
-    return errors
+        return (tutor.email, repl)
+    with model.transaction():
+        mailing = model.Mailing.create(subject, content, TUTOR_EMAIL_VARIABLES)
+        nb_mails = model.Mail.create_for_mailing(mailing, map(pred, tutors),
+                                                 load=False)
+        session.set_emailed_tutors()
+    return nb_mails
 
 
 def read_contacts(fd):
-    people = list(csv.reader(fd, delimiter=','))
-    headers = people[0]
-    people = list(map(lambda x:dict(zip(headers, x)), people[1:]))
-    return people
+    """Yields the rows of a CSV file as dicts whose keys are the
+    headers."""
+    reader = csv.reader(fd, delimiter=',')
+    headers = next(reader, [])
+    for row in reader:
+        yield dict(zip(headers, row))
+
+def import_tutors(fd, chunk_size=500, on_chunk=None):
+    """Creates a tutor for each contact of the CSV file whose email is
+    not a tutor's yet, `chunk_size` contacts at a time. Returns the number
+    of imported and ignored contacts.
 
-def import_tutors(fd):
-    raw = read_contacts(fd)
+    Each chunk is a transaction, in which `on_chunk(nb_rows, nb_imported,
+    nb_ignored)` is called with the totals so far. An interrupted import
+    can be run again: the contacts it imported are then ignored."""
+    contacts = read_contacts(fd)
+    nb_rows = 0
     nb_imported = 0
     nb_ignored = 0
-    for row in raw:
-        email = row['E-mail Address'].decode('latin1')
-        name = '%s %s' % (row['First Name'], row['Last Name'])
-        name = name.decode('latin1')
-        try:
-            model.Tutor.get(email)
-        except model.NotFound:
-            model.Tutor.create(email, name)
-            nb_imported += 1
-        else:
-            nb_ignored += 1
-            continue
+    while True:
+        chunk = list(itertools.islice(contacts, chunk_size))
+        if not chunk:
+            break
+        with model.transaction():
+            tutors = collections.OrderedDict()
+            for row in chunk:
+                email = row['E-mail Address'].decode('latin1')
+                name = '%s %s' % (row['First Name'], row['Last Name'])
+                tutors.setdefault(email, name.decode('latin1'))
+            existing = model.Tutor.existing_emails(tutors)
+            new = [x for x in tutors.items() if x[0] not in existing]
+            model.Tutor.create_many(new, load=False)
+            nb_rows += len(chunk)
+            nb_imported += len(new)
+            nb_ignored += len(chunk) - len(new)
+            if on_chunk:
+                on_chunk(nb_rows, nb_imported, nb_ignored)
     return (nb_imported, nb_ignored)
@@ -1,31 +1,173 @@
+import time
+import Queue
+import base64
 import smtplib
+import threading
 import collections
-from email.mime.text import MIMEText
+from email.header import Header
 
 from config import config
 
-class Sender(object):
-    def __init__(self):
-        self.server = smtplib.SMTP(config['email']['server'])
-        self.server.starttls()
-        self.server.login(config['email']['username'],
-                config['email']['password'])
+def encode_header(value):
+    """Encodes a header value as RFC 2047 if it is not ASCII."""
+    try:
+        return value.encode('ascii')
+    except UnicodeError:
+        return Header(value, 'utf8').encode()
 
-    def __die__(self):
-        self.server.quit()
+class RateLimiter(object):
+    """Makes callers of `wait()` wait so that there are at most `rate`
+    calls per second. A rate of 0 means no limit."""
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            at = max(now, self._next)
+            self._next = at + 1. / self.rate
+        if at > now:
+            time.sleep(at - now)
+
+class Connection(object):
+    """SMTP connection which is opened on first use, opened again if the
+    server closed it, and renewed after `max_messages` messages. It sends
+    at most `rate` messages per second (0 for no limit)."""
+    def __init__(self, server, username=None, password=None, starttls=True,
+            max_messages=100, rate=0):
+        self.address = server
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.max_messages = max_messages
+        self.limiter = RateLimiter(rate)
+        self.server = None
+        self.nb_messages = 0
+
+    def connect(self):
+        self.close()
+        server = smtplib.SMTP(self.address)
+        try:
+            if self.starttls:
+                server.starttls()
+            if self.username:
+                server.login(self.username, self.password)
+        except:
+            # Never used without encryption or authentication
+            server.close()
+            raise
+        self.server = server
+        self.nb_messages = 0
+
+    def close(self):
+        if self.server is not None:
+            (server, self.server) = (self.server, None)
+            try:
+                server.quit()
+            except smtplib.SMTPServerDisconnected:
+                pass
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        self.limiter.wait()
+        if self.server is None or self.nb_messages >= self.max_messages:
+            self.connect()
+        try:
+            self.server.sendmail(from_addr, to_addrs, msg)
+        except smtplib.SMTPServerDisconnected:
+            self.connect()
+            self.server.sendmail(from_addr, to_addrs, msg)
+        self.nb_messages += 1
+
+class SMTPSender(object):
+    """Sends mails through up to `pool_size` SMTP connections, which are
+    kept open between mails and can be used by several threads at once.
+    The "rate" and "connection_rate" settings limit the number of mails
+    sent per second, overall and by each connection.
+
+    `email_config` defaults to the "email" section of the configuration."""
+    def __init__(self, email_config=None):
+        self.config = email_config or config['email']
+        self.pool_size = self.config.get('pool_size', 2)
+        self.limiter = RateLimiter(self.config.get('rate', 0))
+        self._idle = Queue.LifoQueue()
+        self._connections = []
+        self._lock = threading.Lock()
+        # The headers which are the same for every mail.
+        self._headers = ''.join('%s: %s\n' % x for x in (
+            ('Content-Type', 'text/plain; charset="utf-8"'),
+            ('MIME-Version', '1.0'),
+            ('Content-Transfer-Encoding', 'base64'),
+            ('From', encode_header(self.config['from'])),
+            ('Bcc', encode_header(self.config['bcc'])),
+            ))
+        # Encoding a header is slow, and all the mails of a mailing
+        # usually have the same subject.
+        self._last_subject = (None, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+        with self._lock:
+            if len(self._connections) < self.pool_size:
+                conn = Connection(self.config['server'],
+                        self.config.get('username'),
+                        self.config.get('password'),
+                        self.config.get('starttls', True),
+                        self.config.get('max_messages_per_connection', 100),
+                        self.config.get('connection_rate', 0))
+                self._connections.append(conn)
+                return conn
+        return self._idle.get()
+
+    def format(self, recipient, subject, content):
+        """Returns the message as it is sent to the SMTP server; this is
+        what MIMEText would build, without creating a MIME object for
+        each mail."""
+        (last_subject, encoded_subject) = self._last_subject
+        if subject != last_subject:
+            encoded_subject = encode_header(subject)
+            self._last_subject = (subject, encoded_subject)
+        return ''.join((self._headers,
+            'Subject: ', encoded_subject, '\n',
+            'To: ', encode_header(recipient), '\n',
+            '\n',
+            base64.encodestring(content.encode('utf8'))))
 
     def send(self, recipient, subject, content):
-        msg = MIMEText(content, _charset='utf8')
-        msg['Subject'] = subject
-        msg['From'] = config['email']['from']
-        msg['To'] = recipient
-        msg['Bcc'] = config['email']['bcc']
-        self.server.sendmail(config['email']['from'],
-                [recipient, config['email']['bcc']],
-                msg.as_string())
+        msg = self.format(recipient, subject, content)
+        self.limiter.wait()
+        conn = self._acquire()
+        try:
+            conn.sendmail(self.config['from'],
+                    [recipient, self.config['bcc']],
+                    msg)
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+
+Sender = SMTPSender
 
 class MockSender(object):
     queue = []
 
     def send(self, recipient, subject, content):
         self.queue.append((recipient, subject, content))
+
+    def close(self):
+        pass
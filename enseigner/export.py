@@ -0,0 +1,168 @@
+"""Spreadsheets (ODS and CSV) generated incrementally from iterables of
+rows, as iterators of strings which can be sent as they are produced."""
+import csv
+import zlib
+import time
+import struct
+import decimal
+import zipfile
+import datetime
+from cStringIO import StringIO
+from xml.sax.saxutils import escape, quoteattr
+
+from odswriter import ods_components
+
+class ZipStream(object):
+    """Writes a zip archive without seeking back in the output: the CRC
+    and the sizes of each compressed entry are written after its data.
+    Each method returns an iterator of the archive's bytes."""
+    def __init__(self):
+        self._entries = []
+        self._offset = 0
+
+    def _local_header(self, name, method, flags, crc, compressed_size, size):
+        if isinstance(name, unicode):
+            name = name.encode('utf8')
+            flags |= 0x800 # Bit 11: the name is in UTF-8
+        (dostime, dosdate) = self._dos_time()
+        header = struct.pack(zipfile.structFileHeader,
+                zipfile.stringFileHeader, 20, 0, flags, method,
+                dostime, dosdate, crc, compressed_size, size, len(name), 0)
+        self._entries.append((name, method, flags, dostime, dosdate,
+                              self._offset))
+        return header + name
+
+    @staticmethod
+    def _dos_time():
+        t = time.localtime()
+        return (t[3] << 11 | t[4] << 5 | t[5] // 2,
+                (t[0] - 1980) << 9 | t[1] << 5 | t[2])
+
+    def _emit(self, data):
+        self._offset += len(data)
+        return data
+
+    def add_stored(self, name, data):
+        """Yields an uncompressed entry whose sizes are in its header
+        (eg. the "mimetype" entry of OpenDocument files)."""
+        crc = zlib.crc32(data) & 0xffffffff
+        yield self._emit(self._local_header(name, zipfile.ZIP_STORED, 0,
+                                            crc, len(data), len(data)))
+        yield self._emit(data)
+        self._entries[-1] += (crc, len(data), len(data))
+
+    def add(self, name, chunks):
+        """Yields a compressed entry made of the strings of `chunks`."""
+        # Bit 3: sizes and CRC are in the data descriptor
+        yield self._emit(self._local_header(name, zipfile.ZIP_DEFLATED,
+                                            0x08, 0, 0, 0))
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        crc = 0
+        size = 0
+        compressed_size = 0
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                compressed_size += len(data)
+                yield self._emit(data)
+        data = compressor.flush()
+        compressed_size += len(data)
+        yield self._emit(data)
+        crc &= 0xffffffff
+        yield self._emit(struct.pack('<4s3L', 'PK\x07\x08',
+                                     crc, compressed_size, size))
+        self._entries[-1] += (crc, compressed_size, size)
+
+    def close(self):
+        """Yields the central directory, which ends the archive."""
+        start = self._offset
+        for (name, method, flags, dostime, dosdate, offset,
+                crc, compressed_size, size) in self._entries:
+            yield self._emit(struct.pack(zipfile.structCentralDir,
+                    zipfile.stringCentralDir, 20, 0, 20, 0, flags, method,
+                    dostime, dosdate, crc, compressed_size, size,
+                    len(name), 0, 0, 0, 0, 0, offset) + name)
+        yield struct.pack(zipfile.structEndArchive,
+                zipfile.stringEndArchive, 0, 0,
+                len(self._entries), len(self._entries),
+                self._offset - start, start, 0)
+
+(CONTENT_HEADER, CONTENT_FOOTER) = \
+        ods_components.content_xml.split('</office:spreadsheet>')
+
+def _ods_cell(value):
+    # Same cells as odswriter's
+    if value is None:
+        return '<table:table-cell/>'
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        text = value.isoformat()
+        attributes = ('office:value-type="date" office:date-value="%s" '
+                      'table:style-name="cDateISO"' % text)
+    elif isinstance(value, bool):
+        text = 'TRUE' if value else 'FALSE'
+        attributes = ('office:value-type="boolean" '
+                      'office:boolean-value="%s" table:style-name="cBool"' %
+                      ('true' if value else 'false'))
+    elif isinstance(value, (int, long, float, decimal.Decimal)):
+        text = unicode(value)
+        attributes = 'office:value-type="float" office:value="%s"' % text
+    else:
+        text = unicode(value)
+        attributes = 'office:value-type="string"'
+    if not text:
+        return '<table:table-cell %s/>' % attributes
+    return u'<table:table-cell %s><text:p>%s</text:p></table:table-cell>' % \
+            (attributes, escape(text))
+
+def _ods_content(sheets):
+    yield CONTENT_HEADER.encode('utf8')
+    for (name, rows) in sheets:
+        yield ('<table:table table:name=%s table:style-name="ta1">' %
+               quoteattr(name)).encode('utf8')
+        for row in rows:
+            yield (u'<table:table-row>%s</table:table-row>' %
+                   u''.join(map(_ods_cell, row))).encode('utf8')
+        yield '</table:table>'
+    yield ('</office:spreadsheet>' + CONTENT_FOOTER).encode('utf8')
+
+def to_ods(sheets):
+    """Yields an ODS file with a sheet for each (name, rows) of
+    `sheets`."""
+    archive = ZipStream()
+    for entries in (
+            archive.add_stored('mimetype',
+                               ods_components.mimetype.encode('utf8')),
+            archive.add('META-INF/manifest.xml',
+                        [ods_components.manifest_xml.encode('utf8')]),
+            archive.add('styles.xml',
+                        [ods_components.styles_xml.encode('utf8')]),
+            archive.add('content.xml', _ods_content(sheets)),
+            archive.close()):
+        for data in entries:
+            yield data
+
+def to_csv_zip(sheets):
+    """Yields a zip archive with a CSV file for each (name, rows) of
+    `sheets`."""
+    archive = ZipStream()
+    for (name, rows) in sheets:
+        for data in archive.add(name + '.csv', to_csv(rows)):
+            yield data
+    for data in archive.close():
+        yield data
+
+def to_csv(rows, buffer_size=16384):
+    """Yields a CSV file, in UTF-8, `buffer_size` bytes at a time."""
+    io = StringIO()
+    writer = csv.writer(io)
+    for row in rows:
+        writer.writerow([x.encode('utf8') if isinstance(x, unicode)
+                         else '' if x is None else x
+                         for x in row])
+        if io.tell() >= buffer_size:
+            yield io.getvalue()
+            io = StringIO()
+            writer = csv.writer(io)
+    yield io.getvalue()
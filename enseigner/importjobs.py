@@ -0,0 +1,47 @@
+"""Imports of contacts files in the background of the web application:
+the uploaded file is saved to disk, then imported by a thread which
+records its progress in the `import_jobs` table."""
+import os
+import uuid
+import shutil
+import tempfile
+import threading
+
+import model
+import controller
+from config import config
+
+def spool(fd):
+    """Saves the file to the "import_dir" directory of the configuration
+    (the system's temporary directory by default), and returns a pending
+    job importing it."""
+    directory = config.get('import_dir') or tempfile.gettempdir()
+    path = os.path.join(directory, 'enseigner-import-%s.csv' % uuid.uuid4())
+    with open(path, 'wb') as output:
+        shutil.copyfileobj(fd, output)
+    return model.ImportJob.create(path)
+
+def run(job, chunk_size=500):
+    """Imports the tutors of the job's file, then deletes the file."""
+    job.set_state('running')
+    try:
+        with open(job.path, 'rb') as fd:
+            controller.import_tutors(fd, chunk_size, job.set_progress)
+    except Exception as e:
+        job.set_state('failed', repr(e))
+    else:
+        job.set_state('done')
+    finally:
+        os.remove(job.path)
+
+def start(job):
+    """Runs the job in a new thread, and returns the thread."""
+    def target():
+        try:
+            run(job)
+        finally:
+            model.release_conn()
+    thread = threading.Thread(target=target, name='import-%d' % job.jid)
+    thread.daemon = True
+    thread.start()
+    return thread
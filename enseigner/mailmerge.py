@@ -0,0 +1,51 @@
+# -*- coding: utf8 -*-
+"""Mail merge: templates using string.Template's `$name` syntax, parsed
+once per mailing and rendered for each recipient."""
+import string
+
+class TemplateError(ValueError):
+    pass
+
+class Template(object):
+    """A string.Template which is checked when it is created: it raises
+    TemplateError if the template is malformed or uses a placeholder which
+    is not in `variables`."""
+    def __init__(self, template, variables):
+        self.template = template
+        self.variables = frozenset(variables)
+        parts = []
+        last = 0
+        for match in string.Template.pattern.finditer(template):
+            parts.append(template[last:match.start()].replace('%', '%%'))
+            last = match.end()
+            if match.group('escaped') is not None:
+                parts.append('$')
+                continue
+            name = match.group('named') or match.group('braced')
+            if name is None:
+                raise TemplateError(u'« $ » invalide à la position %d '
+                        u'(utiliser « $$ » pour écrire un « $ »).' %
+                        match.start('invalid'))
+            if name not in self.variables:
+                raise TemplateError(u'Variable inconnue : $%s '
+                        u'(variables possibles : %s).' %
+                        (name, ', '.join('$' + x
+                                         for x in sorted(self.variables))))
+            parts.append('%%(%s)s' % name)
+        parts.append(template[last:].replace('%', '%%'))
+        # Rendering is then a single % operation.
+        self._format = ''.join(parts)
+
+    def render(self, variables):
+        return self._format % variables
+
+class MailTemplate(object):
+    """Subject and content of a mailing."""
+    def __init__(self, subject, content, variables):
+        self.subject = Template(subject, variables)
+        self.content = Template(content, variables)
+
+    def render(self, variables):
+        """Returns the (subject, content) pair for a recipient."""
+        return (self.subject.render(variables),
+                self.content.render(variables))
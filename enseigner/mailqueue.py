@@ -0,0 +1,241 @@
+"""Delivery of the mails queued in the `mails` table, in the background
+of the web application or from a separate process (see mail_worker.py)."""
+import time
+import Queue
+import random
+import datetime
+import itertools
+import threading
+
+import model
+import emails
+from config import config
+
+class SentBatch(object):
+    """Collects delivered mails, and marks them as sent in the database
+    `size` at a time, or as soon as the oldest one waited for more than
+    `max_delay` seconds.
+
+    Mails which were delivered but not marked yet (eg. because the
+    process was killed) are sent again later: each mail is delivered at
+    least once."""
+    def __init__(self, size=100, max_delay=5):
+        self.size = size
+        self.max_delay = max_delay
+        self._mails = []
+        self._since = None
+
+    def add(self, mail):
+        if not self._mails:
+            self._since = time.time()
+        self._mails.append(mail)
+        if len(self._mails) >= self.size or \
+                time.time() - self._since >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        if self._mails:
+            model.Mail.set_sent_many(self._mails)
+            self._mails = []
+
+class Worker(object):
+    """Sends the unsent mails of the database, either once with
+    `drain()`, or continuously from a thread which drains the queue every
+    `poll_interval` seconds or when woken up.
+
+    Mails are sent by `nb_threads` threads at once, one per SMTP
+    connection of the sender; the outcome of each mail is recorded in
+    the database by the thread which called `drain()`. A mail which could
+    not be sent is tried again `retry_delay` seconds later, then twice
+    that delay later, and so on until it was tried `max_attempts` times.
+
+    Several workers can drain the queue at once (eg. send_unsent.py and
+    the web application's): each mail is claimed for `claim_timeout`
+    seconds before it is sent, and the other workers skip it. This must
+    be longer than sending `claim_batch_size` mails takes."""
+    def __init__(self, poll_interval=None, nb_threads=None):
+        email_config = config['email']
+        if poll_interval is None:
+            poll_interval = email_config.get('poll_interval', 60)
+        if nb_threads is None:
+            nb_threads = email_config.get('pool_size', 2)
+        self.poll_interval = poll_interval
+        self.nb_threads = nb_threads
+        self.max_attempts = email_config.get('max_attempts', 8)
+        self.retry_delay = email_config.get('retry_delay', 60)
+        self.max_retry_delay = email_config.get('max_retry_delay', 6*3600)
+        self.ack_batch_size = email_config.get('ack_batch_size', 100)
+        self.ack_max_delay = email_config.get('ack_max_delay', 5)
+        self.claim_batch_size = email_config.get('claim_batch_size', 100)
+        self.claim_timeout = email_config.get('claim_timeout', 600)
+        # Kept between drains, so are its SMTP connections.
+        self.sender = None
+        self.nb_sent = 0
+        self.last_error = None
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def drain(self, now=None):
+        """Sends all mails due for an attempt, and returns a list of
+        (mail, exception) for those that could not be sent."""
+        mails = self._claim(model.Mail.iter_due(self.max_attempts, now,
+                                                self.claim_batch_size),
+                            now)
+        try:
+            first = next(mails)
+        except StopIteration:
+            return []
+        mails = itertools.chain([first], mails)
+        if self.sender is None:
+            self.sender = emails.Sender()
+        sender = self.sender
+        todo = Queue.Queue(2 * self.nb_threads)
+        done = Queue.Queue()
+        def send():
+            while True:
+                item = todo.get()
+                if item is None:
+                    return
+                (mail, subject, content) = item
+                try:
+                    sender.send(mail.recipient, subject, content)
+                except Exception as e:
+                    done.put((mail, e))
+                else:
+                    done.put((mail, None))
+        threads = [threading.Thread(target=send, name='mailqueue-send')
+                   for i in range(self.nb_threads)]
+        for thread in threads:
+            thread.start()
+
+        errors = []
+        batch = SentBatch(self.ack_batch_size, self.ack_max_delay)
+        def record(block):
+            try:
+                (mail, error) = done.get(block)
+            except Queue.Empty:
+                return False
+            self._record(mail, error, batch, errors)
+            return True
+        nb_pending = 0
+        try:
+            for mail in mails:
+                # Rendered here, as the sending threads may not use
+                # the database.
+                todo.put((mail,) + mail.render())
+                nb_pending += 1
+                while nb_pending and record(False):
+                    nb_pending -= 1
+            while nb_pending:
+                record(True)
+                nb_pending -= 1
+        finally:
+            for thread in threads:
+                todo.put(None)
+            for thread in threads:
+                thread.join()
+            # Also after an error, so the mails which were delivered are
+            # not sent again.
+            try:
+                while record(False):
+                    pass
+            finally:
+                batch.flush()
+        return errors
+
+    def _claim(self, mails, now):
+        """Yields the mails this worker claimed among `mails`, claiming
+        `claim_batch_size` of them at a time."""
+        while True:
+            chunk = list(itertools.islice(mails, self.claim_batch_size))
+            if not chunk:
+                return
+            # The random part keeps the claims of two workers apart, even
+            # when they claim at the same time.
+            until = datetime.datetime.now() + datetime.timedelta(
+                    seconds=self.claim_timeout,
+                    microseconds=random.randrange(1000000))
+            for mail in model.Mail.claim_many(chunk, until, now):
+                yield mail
+
+    def _record(self, mail, error, batch, errors):
+        if error is None:
+            batch.add(mail)
+            self.nb_sent += 1
+        else:
+            errors.append((mail, error))
+            if mail.attempts + 1 >= self.max_attempts:
+                next_attempt = None
+            else:
+                delay = min(self.retry_delay * 2 ** mail.attempts,
+                            self.max_retry_delay)
+                next_attempt = datetime.datetime.now() + \
+                        datetime.timedelta(seconds=delay)
+            mail.set_failed(repr(error), next_attempt)
+
+    def close(self):
+        if self.sender is not None:
+            self.sender.close()
+            self.sender = None
+
+    def _timeout(self):
+        """Returns how long to wait before the next drain."""
+        next_attempt = model.Mail.next_attempt_time(self.max_attempts)
+        if next_attempt is None:
+            return self.poll_interval
+        delay = next_attempt - datetime.datetime.now()
+        delay = delay.days * 86400 + delay.seconds + 1
+        return max(0, min(self.poll_interval, delay))
+
+    def run_forever(self):
+        while True:
+            self._wakeup.clear()
+            timeout = self.poll_interval
+            try:
+                self.drain()
+                timeout = self._timeout()
+            except Exception as e:
+                self.last_error = e
+            finally:
+                model.release_conn()
+            self._wakeup.wait(timeout)
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run_forever,
+                                                name='mailqueue')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def status(self):
+        (queued, retrying, failed) = \
+                model.Mail.count_by_state(self.max_attempts)
+        return {'queued': queued,
+                'retrying': retrying,
+                'failed': failed,
+                'sent': self.nb_sent,
+                'running': self._thread is not None and self._thread.is_alive(),
+                'last_error': None if self.last_error is None
+                              else repr(self.last_error),
+                }
+
+worker = Worker()
+
+def start():
+    """Starts the worker thread, and returns whether it did. Does nothing
+    if mails are sent by a separate process (config['email']['worker'] ==
+    'process')."""
+    if config['email'].get('worker', 'thread') == 'thread':
+        worker.start()
+        return True
+    return False
+
+def notify():
+    """Tells the worker new mails were queued."""
+    if start():
+        worker.wake()
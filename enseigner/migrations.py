@@ -0,0 +1,120 @@
+"""Versioned changes of the database schema, so existing databases can be
+upgraded to the schema of the models (see upgrade_db.py).
+
+Migrations are applied in order, and the `schema_migrations` table records
+those which were. Each migration only changes what is missing, so it can
+be applied to a database created from the models' current `_create_table`
+(as make_db.py does), or run again if it was interrupted: the sqlite3
+module commits before each schema change, so a migration is not atomic."""
+import datetime
+
+import model
+
+_create_table = '''CREATE TABLE IF NOT EXISTS schema_migrations (
+    migration_version INTEGER PRIMARY KEY,
+    migration_name TEXT,
+    migration_applied_at DATETIME
+    )'''
+
+migrations = []
+def migration(f):
+    """Appends the function to the migrations; its version is its
+    position in the list, starting at 1. Never reorder them."""
+    migrations.append(f)
+    return f
+
+def _add_columns(conn, table, columns):
+    existing = set(x[1] for x in
+                   conn.execute('PRAGMA table_info(%s)' % table))
+    for (name, definition) in columns:
+        if name not in existing:
+            conn.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                         (table, name, definition))
+
+# The statements are copied rather than taken from the models, so a later
+# change of a model does not change what a migration does.
+
+@migration
+def mail_delivery(conn):
+    """Delivery attempts of the mails."""
+    _add_columns(conn, 'mails', [
+        ('mail_attempts', 'INTEGER NOT NULL DEFAULT 0'),
+        ('mail_last_error', 'TEXT'),
+        ('mail_next_attempt', 'DATETIME'),
+        ('mail_sent_at', 'DATETIME'),
+        ])
+
+@migration
+def mailings(conn):
+    """Templates shared by the mails of a mailing."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS mailings (
+        mailing_id INTEGER PRIMARY KEY,
+        mailing_subject TEXT,
+        mailing_content TEXT,
+        mailing_variables TEXT,
+        mailing_created_at DATETIME
+        )''')
+    _add_columns(conn, 'mails', [
+        ('mail_mailing_id', 'INTEGER REFERENCES mailings(mailing_id)'),
+        ('mail_variables', 'TEXT'),
+        ])
+
+@migration
+def import_jobs(conn):
+    """Imports of contacts files run in the background."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS import_jobs (
+        job_id INTEGER PRIMARY KEY,
+        job_path TEXT,
+        job_state TEXT,
+        job_nb_rows INTEGER NOT NULL DEFAULT 0,
+        job_nb_imported INTEGER NOT NULL DEFAULT 0,
+        job_nb_ignored INTEGER NOT NULL DEFAULT 0,
+        job_error TEXT,
+        job_created_at DATETIME,
+        job_updated_at DATETIME
+        )''')
+
+@migration
+def rate_limits(conn):
+    """Login throttling counters shared by processes."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS rate_limits (
+        rl_key TEXT,
+        rl_bucket INTEGER,
+        rl_count INTEGER,
+        rl_expires REAL,
+        PRIMARY KEY (rl_key, rl_bucket)
+        )''')
+
+@migration
+def indexes(conn):
+    """Indexes of the queries scanning whole tables.
+
+    Registrations by session and subjects by registration already use
+    the indexes of their UNIQUE constraints."""
+    # Also serves the mail_id ranges of Mail._iter_where, as the rowid is
+    # part of the index.
+    conn.execute('CREATE INDEX IF NOT EXISTS mails_sent ON mails (mail_sent)')
+    conn.execute('''CREATE INDEX IF NOT EXISTS sessions_date
+                    ON sessions (session_date)''')
+
+def current_version(conn=None):
+    """Returns the version of the last migration applied to the
+    database, 0 if none was."""
+    conn = conn or model.get_conn()
+    conn.execute(_create_table)
+    return conn.execute('''SELECT COALESCE(MAX(migration_version), 0)
+                           FROM schema_migrations''').fetchone()[0]
+
+def upgrade(conn=None):
+    """Applies the migrations which were not applied to the database yet,
+    and returns their names."""
+    conn = conn or model.get_conn()
+    version = current_version(conn)
+    applied = []
+    for (i, f) in enumerate(migrations[version:], version + 1):
+        with conn:
+            f(conn)
+            conn.execute('INSERT INTO schema_migrations VALUES (?, ?, ?)',
+                         (i, f.__name__, datetime.datetime.now()))
+        applied.append(f.__name__)
+    return applied
@@ -1,10 +1,18 @@
 from future_builtins import map, filter
 import os
+import hmac
+import json
+import time
 import hashlib
 import sqlite3
 import weakref
 import datetime
+import itertools
+import threading
+import contextlib
+import collections
 
+import mailmerge
 from config import config
 
 class NotFound(Exception):
@@ -19,21 +27,276 @@ class Contradictory(Exception):
 tables = []
 def register(cls):
     tables.append(cls)
+    cls._instances = IdentityMap(
+            config.get('cache_sizes', {}).get(cls._table, cls._cache_size))
     return cls
 
 
-def password_hash(tutor_id, password):
+def legacy_password_hash(tutor_id, password):
+    """Hash of passwords set before PBKDF2 was used; they are replaced on
+    login."""
     salt = config['password_salt']
     assert len(salt) >= 20, 'Salt is not long enough'
     return hashlib.sha512('%s|%d|%s' % (salt, tutor_id, password)).hexdigest()
 
+def password_hash(password, salt=None, iterations=None):
+    """Returns the PBKDF2-SHA256 hash of the password with a random salt
+    and "password_iterations" iterations, as it is stored in the database:
+    "pbkdf2_sha256$<iterations>$<salt>$<hash>"."""
+    if iterations is None:
+        iterations = config.get('password_iterations', 100000)
+    if salt is None:
+        salt = os.urandom(16).encode('hex')
+    if isinstance(password, unicode):
+        password = password.encode('utf8')
+    hash_ = hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+    return 'pbkdf2_sha256$%d$%s$%s' % (iterations, salt, hash_.encode('hex'))
+
+def check_password_hash(stored, tutor_id, password):
+    """Returns whether the password matches the stored hash, compared in
+    constant time, and whether the stored hash should be replaced because
+    it is a legacy hash or uses less iterations than configured."""
+    if not stored or not stored.startswith('pbkdf2_sha256$'):
+        # As slow as checking a PBKDF2 hash, so the response time does not
+        # tell which tutors have no password (eg. imported ones) or a
+        # legacy hash.
+        password_hash(password)
+    if not stored:
+        return (False, False)
+    if not stored.startswith('pbkdf2_sha256$'):
+        # compare_digest does not compare str with unicode
+        return (hmac.compare_digest(legacy_password_hash(tutor_id, password),
+                                    stored.encode('utf8')),
+                True)
+    (algorithm, iterations, salt, hash_) = stored.split('$')
+    iterations = int(iterations)
+    valid = hmac.compare_digest(
+            password_hash(password, str(salt), iterations),
+            stored.encode('utf8'))
+    return (valid, iterations < config.get('password_iterations', 100000))
+
+
+class ConnectionPool(object):
+    """Hands out one SQLite connection per thread.
+
+    A thread keeps the same connection until it calls `release()`, which
+    rolls back anything left uncommitted and puts the connection back in
+    the pool. At most `max_size` idle connections are kept; extra ones are
+    closed. PRAGMAs are only run when a connection is opened."""
+    def __init__(self, database, max_size=5, pragmas=()):
+        self.database = database
+        self.max_size = max_size
+        self.pragmas = tuple(pragmas)
+        self._idle = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _connect(self):
+        # Idle connections may be picked up by another thread than the one
+        # which opened them; the pool guarantees they are never shared.
+        conn = sqlite3.connect(self.database, check_same_thread=False)
+        for pragma in self.pragmas:
+            conn.execute('PRAGMA %s' % pragma)
+        return conn
+
+    def get(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def release(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            return
+        self._local.conn = None
+        conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        self.release()
+        with self._lock:
+            (idle, self._idle) = (self._idle, [])
+        for conn in idle:
+            conn.close()
+
+DEFAULT_PRAGMAS = ('journal_mode=WAL', 'synchronous=NORMAL')
+
+pool = ConnectionPool(config['database'],
+        config.get('database_pool_size', 5),
+        config.get('database_pragmas', DEFAULT_PRAGMAS))
 
 def get_conn(): # pragma: no cover
-    conn = sqlite3.connect(config['database'])
-    return conn
+    return pool.get()
+
+def release_conn(): # pragma: no cover
+    pool.release()
+
+_state = threading.local()
+
+def in_transaction():
+    return getattr(_state, 'transaction_depth', 0) > 0
+
+@contextlib.contextmanager
+def transaction(snapshot=False):
+    """Runs every model call of the block on the same connection, as a
+    single transaction which is committed when the block exits, or
+    rolled back if it raises.
+
+    The sqlite3 module only starts the transaction before the first
+    write. If `snapshot` is true, it is started at once, so all the reads
+    of the block see the database as it was then. A nested block uses
+    the transaction of the outermost one.
+
+    Blocks can be nested; only the outermost one commits. Model
+    exceptions raised inside the block (eg. `Duplicate`) must be left to
+    propagate out of it, otherwise their partial writes get committed
+    along with the rest."""
+    depth = getattr(_state, 'transaction_depth', 0)
+    conn = get_conn()
+    if snapshot and depth == 0:
+        conn.execute('BEGIN')
+    _state.transaction_depth = depth + 1
+    try:
+        yield conn
+    except:
+        if depth == 0:
+            conn.rollback()
+            # Instances created or modified by the block no longer match
+            # the database.
+            for table in tables:
+                table._instances.clear()
+            subject_catalog.invalidate()
+        raise
+    else:
+        if depth == 0:
+            conn.commit()
+    finally:
+        _state.transaction_depth = depth
+
+def _commit(conn):
+    if not in_transaction():
+        conn.commit()
+
+def _rollback(conn):
+    if not in_transaction():
+        conn.rollback()
+
+class IdentityMap(object):
+    """Maps ids to the instance of the matching row, so there is at most
+    one instance per row.
+
+    Instances are referenced weakly, except the `size` most recently
+    used ones, which the map keeps alive. `lookup()` counts hits and
+    misses, and does not return instances invalidated by a write until
+    their row is fetched again."""
+    def __init__(self, size=0):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._weak = weakref.WeakValueDictionary()
+        self._recent = collections.OrderedDict()
+        # Instances rather than ids, so they are forgotten with the
+        # instance.
+        self._stale = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+    def __contains__(self, id_):
+        return id_ in self._weak
+
+    def __getitem__(self, id_):
+        return self._weak[id_]
+
+    def get(self, id_, default=None):
+        return self._weak.get(id_, default)
+
+    def __setitem__(self, id_, instance):
+        with self._lock:
+            self._weak[id_] = instance
+            self._stale.discard(instance)
+            self._touch(id_, instance)
+
+    def add_new(self, items):
+        """Adds the (id, instance) pairs of rows which were just
+        inserted, holding the lock once. Returns the pairs whose id
+        already had an instance (a deleted row's id can be reused); they
+        are not added."""
+        with self._lock:
+            known = set(self._weak.keys())
+            if known:
+                r = [x for x in items if x[0] in known]
+                items = [x for x in items if x[0] not in known]
+            else:
+                r = []
+            self._weak.update(items)
+            if self.size > 0:
+                for (id_, instance) in items[-self.size:]:
+                    self._touch(id_, instance)
+            return r
+
+    def __delitem__(self, id_):
+        with self._lock:
+            self._stale.discard(self._weak.pop(id_))
+            self._recent.pop(id_, None)
+
+    def _touch(self, id_, instance):
+        if self.size <= 0:
+            return
+        self._recent.pop(id_, None)
+        self._recent[id_] = instance
+        if len(self._recent) > self.size:
+            self._recent.popitem(last=False)
+
+    def lookup(self, id_):
+        with self._lock:
+            instance = self._weak.get(id_)
+            if instance in self._stale:
+                instance = None
+            if instance is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._touch(id_, instance)
+            return instance
+
+    def invalidate(self, id_):
+        with self._lock:
+            instance = self._weak.get(id_)
+            if instance is not None:
+                self._stale.add(instance)
+
+    def clear(self):
+        with self._lock:
+            self._weak.clear()
+            self._recent.clear()
+            self._stale.clear()
+
+def to_bool(value):
+    return None if value is None else bool(value)
+
+def to_datetime(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    # Format of Python's default sqlite3 adapter for datetime objects
+    format_ = '%Y-%m-%d %H:%M:%S.%f' if '.' in value else '%Y-%m-%d %H:%M:%S'
+    return datetime.datetime.strptime(value, format_)
 
 def _model(nb_keys):
     class Model(object):
+        # Maps field names to functions decoding the values stored in
+        # the database.
+        _converters = {}
+        # Number of recently used instances kept in memory
+        _cache_size = 0
+
         @staticmethod
         def make_id(args):
             return tuple(args[0:nb_keys])
@@ -45,6 +308,11 @@ def _model(nb_keys):
                 self._instances[id_] = self
                 self._attributes = dict(zip(self._fields, args))
 
+        def _refresh(self, row):
+            for name in self._fields:
+                self.__dict__.pop(name, None)
+            self._attributes = dict(zip(self._fields, row))
+
         def __repr__(self):
             return '<enseigner.model.%s(%s)>' % (self.__class__.__name__,
                     ', '.join(['%s=%r' % (x, getattr(self, x))
@@ -52,7 +320,13 @@ def _model(nb_keys):
 
         def __getattr__(self, name):
             if name in self._attributes:
-                return self._attributes[name]
+                value = self._attributes[name]
+                if name in self._converters:
+                    # Decoded on first access only: the instance attribute
+                    # shadows this method from now on.
+                    value = self._converters[name](value)
+                    setattr(self, name, value)
+                return value
             else:
                 raise AttributeError('%r has not attribute %r' % (self, name))
 
@@ -63,17 +337,38 @@ def _model(nb_keys):
             except NotFound:
                 raise ForeignKeyNotMapped()
 
+        @classmethod
+        def _from_row(cls, row):
+            """Returns the instance of the row, after updating it with the
+            row's values if it already existed."""
+            id_ = cls.make_id(row)
+            instance = cls._instances.get(id_)
+            if instance is None:
+                return cls(*row)
+            instance._refresh(row)
+            cls._instances[id_] = instance
+            return instance
+
+        @classmethod
+        def _from_new_rows(cls, rows):
+            """Returns the instances of a list of rows which were just
+            inserted, like _from_row for each of them but faster."""
+            items = []
+            for row in rows:
+                instance = cls.__new__(cls)
+                instance._attributes = dict(zip(cls._fields, row))
+                items.append((cls.make_id(row), instance))
+            known = dict(cls._instances.add_new(items))
+            if not known:
+                return [x[1] for x in items]
+            return [cls._from_row(row) if id_ in known else instance
+                    for (row, (id_, instance)) in zip(rows, items)]
+
         @classmethod
         def _get_or_create(cls, data):
             if not data:
                 raise NotFound()
-            id_ = cls.make_id(data)
-            if id_ in cls._instances:
-                return cls._instances[id_]
-            else:
-                instance = cls(*data)
-                cls._instances[id_] = instance
-                return instance
+            return cls._from_row(data)
 
         @classmethod
         def _fetch_many(cls, request, args=()):
@@ -89,8 +384,7 @@ def _model(nb_keys):
         @classmethod
         def _get_many(cls, request, args=()):
             r = cls._fetch_many(request, args)
-            return {cls._instances.get(cls.make_id(x), None) or cls(*x)
-                    for x in r}
+            return {cls._from_row(x) for x in r}
 
     Model.__name__ = 'Model(%d)' % nb_keys
     return Model
@@ -111,30 +405,48 @@ class SingleKeyModel(_model(1)):
         except sqlite3.IntegrityError:
             raise Duplicate()
         else:
-            conn.commit()
+            _commit(conn)
         finally:
             c.close()
-        return cls(r, *args)
+        return cls._from_row((r,) + tuple(args))
 
     @classmethod
-    def _insert_many(cls, cols, l):
+    def _insert_many(cls, cols, l, chunk_size=500, load=True):
+        """Inserts all rows of the iterable `l` in a single transaction,
+        `chunk_size` rows per statement.
+
+        Returns the list of new instances; or, if `load` is false, only
+        the number of inserted rows."""
         conn = get_conn()
         c = conn.cursor()
+        l = iter(l)
         r = []
+        nb_rows = 0
         try:
-            for args in l:
-                c.execute('INSERT INTO %s (%s) VALUES (%s);' % \
-                          (cls._table, cols, ', '.join('?'*len(args))),
-                          args)
-                r.append((c.lastrowid, args))
+            while True:
+                chunk = list(itertools.islice(l, chunk_size))
+                if not chunk:
+                    break
+                c.executemany('INSERT INTO %s (%s) VALUES (%s);' % \
+                              (cls._table, cols, ', '.join('?'*len(chunk[0]))),
+                              chunk)
+                nb_rows += len(chunk)
+                if not load:
+                    continue
+                # The transaction holds the write lock since the first
+                # insert, so each row got the greatest id so far plus one.
+                c.execute('SELECT MAX(rowid) FROM %s' % cls._table)
+                first_id = c.fetchone()[0] - len(chunk) + 1
+                r.extend(cls._from_new_rows([(first_id + i,) + tuple(args)
+                                             for (i, args) in enumerate(chunk)]))
         except sqlite3.IntegrityError:
-            conn.rollback()
+            _rollback(conn)
             raise Duplicate()
         else:
-            conn.commit()
+            _commit(conn)
         finally:
             c.close()
-        return list(cls(x, *args) for (x, args) in r)
+        return r if load else nb_rows
 
 DoubleKeyModel = _model(2)
 TripleKeyModel = _model(3)
@@ -152,30 +464,50 @@ class Tutor(SingleKeyModel):
         tutor_is_active BOOLEAN,
         tutor_comment TEXT
         )'''
-    _instances = weakref.WeakValueDictionary()
+    _cache_size = 256
     _fields = ('uid', 'email', 'name', 'password_hash', 'phone_number', 'is_admin', 'is_active', 'comment')
+    _converters = {'is_admin': to_bool, 'is_active': to_bool}
 
     @classmethod
     def create(cls, email, name, password=None, phone_number=None, is_admin=False, is_active=True, comment=None):
-        t = cls._insert_one('''tutor_email, tutor_name, tutor_password_hash, tutor_phone_number,
-                               tutor_is_admin, tutor_is_active, tutor_comment''',
-                            (email, name, None, phone_number, is_admin, is_active, comment))
-        if password:
-            t.password_hash = password_hash(t.uid, password)
-            conn = get_conn()
-            c = conn.cursor()
-            try:
-                c.execute('''UPDATE tutors SET tutor_password_hash=?
-                             WHERE tutor_id=?''', (t.password_hash, t.uid))
-                conn.commit()
-            finally:
-                c.close()
+        hash_ = password_hash(password) if password else None
+        return cls._insert_one('''tutor_email, tutor_name, tutor_password_hash, tutor_phone_number,
+                                  tutor_is_admin, tutor_is_active, tutor_comment''',
+                               (email, name, hash_, phone_number, is_admin, is_active, comment))
+
+    @classmethod
+    def create_many(cls, rows, load=True):
+        """Creates active tutors without password from an iterable of
+        (email, name)."""
+        rows = ((email, name, None, None, False, True, None)
+                for (email, name) in rows)
+        return cls._insert_many('''tutor_email, tutor_name,
+                                   tutor_password_hash, tutor_phone_number,
+                                   tutor_is_admin, tutor_is_active,
+                                   tutor_comment''', rows, load=load)
 
-        return t
+    @classmethod
+    def existing_emails(cls, emails):
+        """Returns the subset of `emails` which are emails of tutors."""
+        emails = list(emails)
+        r = set()
+        for i in range(0, len(emails), 500):
+            chunk = emails[i:i+500]
+            r.update(x[0] for x in cls._fetch_many(
+                '''SELECT tutor_email FROM tutors
+                   WHERE tutor_email IN (%s)''' % ', '.join('?'*len(chunk)),
+                chunk))
+        return r
 
 
     @classmethod
-    def get(cls, email_or_id):
+    def get(cls, email_or_id, cached=True):
+        """If `cached` is false, the tutor is read from the database even
+        if its instance is in memory."""
+        if isinstance(email_or_id, int) and cached:
+            instance = cls._instances.lookup(email_or_id)
+            if instance is not None:
+                return instance
         conn = get_conn()
         c = conn.cursor()
         try:
@@ -204,28 +536,55 @@ class Tutor(SingleKeyModel):
         return cls._get_many('''SELECT * FROM tutors
                                 WHERE tutor_is_active=1''')
 
+    @classmethod
+    def all_in_session(cls, session):
+        if isinstance(session, Session):
+            session = session.sid
+        assert isinstance(session, int), session
+        return cls._get_many('''SELECT tutors.* FROM tutors
+                                INNER JOIN tutor_registrations
+                                    ON (treg_tutor_id=tutor_id)
+                                WHERE session_id=?''', (session,))
+
+    @classmethod
+    def all_registered_between(cls, start, end):
+        """Returns the tutors registered to a session whose date is in
+        [start, end[."""
+        return cls._get_many('''SELECT DISTINCT tutors.* FROM tutors
+                                INNER JOIN tutor_registrations
+                                    ON (treg_tutor_id=tutor_id)
+                                INNER JOIN sessions USING (session_id)
+                                WHERE session_date>=? AND session_date<?''',
+                             (start, end))
+
 
     @classmethod
     def check_password(cls, tutor_email, password):
-        conn = get_conn()
-        c = conn.cursor()
-        c.execute('SELECT tutor_id FROM tutors WHERE tutor_email=?',
-                (tutor_email,))
-        r = c.fetchone()
+        """Returns the tutor if the password is theirs, or None. Legacy
+        hashes are replaced by a PBKDF2 hash."""
+        r = cls._fetch_many('''SELECT * FROM tutors
+                               WHERE tutor_email=?''', (tutor_email,))
         if not r:
+            # As slow as a wrong password, so the response time does not
+            # tell which emails are tutors'.
+            password_hash(password)
             return None
-        tutor_id = r[0]
-        try:
-            c.execute('''SELECT * FROM tutors
-                         WHERE tutor_id=? AND tutor_password_hash=?''',
-                      (tutor_id, password_hash(tutor_id, password)))
-            r = c.fetchone()
-        finally:
-            c.close()
-        if r:
-            return cls._instances.get(r[0], None) or cls(*r)
-        else:
+        tutor = cls._from_row(r[0])
+        (valid, outdated) = check_password_hash(tutor.password_hash,
+                                                tutor.uid, password)
+        if not valid:
             return None
+        if outdated:
+            tutor.set_password(password)
+        return tutor
+
+    def set_password(self, password):
+        self.password_hash = password_hash(password)
+        conn = get_conn()
+        conn.execute('''UPDATE tutors SET tutor_password_hash=?
+                        WHERE tutor_id=?''', (self.password_hash, self.uid))
+        _commit(conn)
+        self._instances.invalidate(self.uid)
 
 
 @register
@@ -240,8 +599,9 @@ class Student(SingleKeyModel):
         student_blacklisted BOOLEAN,
         student_comment TEXT
         )'''
-    _instances = weakref.WeakValueDictionary()
-    _fields = ('uid', 'emails', 'name', 'is_active', 'blacklisted', 'comment')
+    _cache_size = 256
+    _fields = ('uid', 'emails', 'name', 'phone_number', 'is_active', 'blacklisted', 'comment')
+    _converters = {'is_active': to_bool, 'blacklisted': to_bool}
 
     @classmethod
     def create(cls, emails, name, phone_number=None, is_active=True, blacklisted=False, comment=None):
@@ -252,12 +612,15 @@ class Student(SingleKeyModel):
 
     @classmethod
     def get(cls, uid):
+        if not isinstance(uid, int):
+            raise ValueError('id should be or int, not %r' %
+                    uid)
+        instance = cls._instances.lookup(uid)
+        if instance is not None:
+            return instance
         conn = get_conn()
         c = conn.cursor()
         try:
-            if not isinstance(uid, int):
-                raise ValueError('id should be or int, not %r' %
-                        uid)
             c.execute('''SELECT * FROM students
                          WHERE student_id=?''',
                       (uid,))
@@ -276,6 +639,17 @@ class Student(SingleKeyModel):
                                 WHERE student_is_active=1
                                 AND student_blacklisted=0''')
 
+    @classmethod
+    def all_registered_between(cls, start, end):
+        """Returns the students registered to a session whose date is in
+        [start, end[."""
+        return cls._get_many('''SELECT DISTINCT students.* FROM students
+                                INNER JOIN student_registrations
+                                    USING (student_id)
+                                INNER JOIN sessions USING (session_id)
+                                WHERE session_date>=? AND session_date<?''',
+                             (start, end))
+
 @register
 class Session(SingleKeyModel):
     _table = 'sessions'
@@ -289,15 +663,12 @@ class Session(SingleKeyModel):
         session_emailed_tutors BOOLEAN,
         session_is_open BOOLEAN
         )'''
-    _instances = weakref.WeakValueDictionary()
+    _cache_size = 64
     _fields = ('sid', 'date', 'managers',
             'session_form_comment_students', 'session_form_comment_tutors',
             'emailed_students', 'emailed_tutors', 'is_open')
-
-    @property
-    def date(self):
-        return datetime.datetime.strptime(self._attributes['date'],
-                '%Y-%m-%d %H:%M:%S')
+    _converters = {'date': to_datetime, 'emailed_students': to_bool,
+                   'emailed_tutors': to_bool, 'is_open': to_bool}
 
     @classmethod
     def create(cls, date, managers,
@@ -317,6 +688,9 @@ class Session(SingleKeyModel):
     @classmethod
     def get(cls, sid):
         assert isinstance(sid, int)
+        instance = cls._instances.lookup(sid)
+        if instance is not None:
+            return instance
         conn = get_conn()
         c = conn.cursor()
         try:
@@ -332,6 +706,36 @@ class Session(SingleKeyModel):
     def all(cls):
         return cls._get_many('''SELECT * FROM sessions''')
 
+    @classmethod
+    def all_between(cls, start, end):
+        """Returns the list of sessions whose date is in [start, end[,
+        by date."""
+        r = cls._fetch_many('''SELECT * FROM sessions
+                               WHERE session_date>=? AND session_date<?
+                               ORDER BY session_date''', (start, end))
+        return [cls._from_row(x) for x in r]
+
+    @classmethod
+    def all_with_counts(cls):
+        """Returns a list of (session, nb_tutors, nb_students) tuples,
+        most recent session first."""
+        r = cls._fetch_many('''SELECT sessions.*,
+                                      COALESCE(nb_tutors, 0),
+                                      COALESCE(nb_students, 0)
+                               FROM sessions
+                               LEFT JOIN (SELECT session_id,
+                                                 COUNT() AS nb_tutors
+                                          FROM tutor_registrations
+                                          GROUP BY session_id)
+                                   USING (session_id)
+                               LEFT JOIN (SELECT session_id,
+                                                 COUNT() AS nb_students
+                                          FROM student_registrations
+                                          GROUP BY session_id)
+                                   USING (session_id)
+                               ORDER BY session_date DESC''')
+        return [(cls._from_row(x[:-2]), x[-2], x[-1]) for x in r]
+
     @property
     def nb_students(self):
         conn = get_conn()
@@ -362,8 +766,9 @@ class Session(SingleKeyModel):
                         session_emailed_tutors=1
                         WHERE session_id=?''',
                      (self.sid,))
-        conn.commit()
-        self.emailed_tutors = 1
+        _commit(conn)
+        self.emailed_tutors = True
+        self._instances.invalidate(self.sid)
 
     def set_emailed_students(self):
         conn = get_conn()
@@ -371,8 +776,9 @@ class Session(SingleKeyModel):
                         session_emailed_students=1
                         WHERE session_id=?''',
                      (self.sid,))
-        conn.commit()
-        self.emailed_students = 1
+        _commit(conn)
+        self.emailed_students = True
+        self._instances.invalidate(self.sid)
 
 
 @register
@@ -388,7 +794,6 @@ class TutorRegistration(SingleKeyModel):
         FOREIGN KEY (treg_tutor_id) REFERENCES tutors(tutor_id),
         UNIQUE (session_id, treg_tutor_id)
         )'''
-    _instances = weakref.WeakValueDictionary()
     _fields = ('trid', 'sid', 'uid', 'group_size', 'comment')
 
     @classmethod
@@ -413,8 +818,19 @@ class TutorRegistration(SingleKeyModel):
         return cls._get_many('''SELECT * FROM tutor_registrations
                                 WHERE session_id=?''', (session,))
 
+    @classmethod
+    def all_between(cls, start, end):
+        return cls._get_many('''SELECT tutor_registrations.*
+                                FROM tutor_registrations
+                                INNER JOIN sessions USING (session_id)
+                                WHERE session_date>=? AND session_date<?''',
+                             (start, end))
+
     @classmethod
     def get(cls, trid):
+        instance = cls._instances.lookup(trid)
+        if instance is not None:
+            return instance
         conn = get_conn()
         c = conn.cursor()
         try:
@@ -452,9 +868,10 @@ class TutorRegistration(SingleKeyModel):
                         treg_group_size=?, treg_comment=?
                         WHERE treg_id=?''',
                      (group_size, comment, self.trid,))
-        conn.commit()
+        _commit(conn)
         self.group_size = group_size
         self.comment = comment
+        self._instances.invalidate(self.trid)
 
 @register
 class Subject(SingleKeyModel):
@@ -465,40 +882,37 @@ class Subject(SingleKeyModel):
         subject_is_exceptional BOOLEAN,
         subject_color TEXT
         )'''
-    _instances = weakref.WeakValueDictionary()
-    _fields = ('sid', 'name', 'color', 'is_exceptional')
+    _cache_size = 256
+    _fields = ('sid', 'name', 'is_exceptional', 'color')
+    _converters = {'is_exceptional': to_bool}
 
     @classmethod
     def create(cls, name, is_exceptional=False, color='#000000'):
-        return cls._insert_one('''subject_name,
-                                  subject_is_exceptional,
-                                  subject_color''',
-                               (name, is_exceptional, color))
+        subject = cls._insert_one('''subject_name,
+                                     subject_is_exceptional,
+                                     subject_color''',
+                                  (name, is_exceptional, color))
+        subject_catalog.invalidate()
+        return subject
 
     @classmethod
     def get(cls, sid):
-        conn = get_conn()
-        c = conn.cursor()
-        try:
-            if not isinstance(sid, int):
-                raise ValueError('id should be or int, not %r' %
-                        sid)
-            c.execute('''SELECT * FROM subjects
-                         WHERE subject_id=?''',
-                      (sid,))
-            r = c.fetchone()
-        finally:
-            c.close()
-        return cls._get_or_create(r)
+        if not isinstance(sid, int):
+            raise ValueError('id should be or int, not %r' %
+                    sid)
+        return subject_catalog.get(sid)
 
     @classmethod
     def all_permanent(cls):
-        return cls._get_many('''SELECT * FROM subjects
-                                WHERE subject_is_exceptional=0''')
+        return subject_catalog.all_permanent()
 
     @classmethod
-    def all(cls):
-        return cls._get_many('''SELECT * FROM subjects''')
+    def all(cls, cached=True):
+        """If `cached` is false, the subjects are read from the database
+        rather than from the catalog."""
+        if not cached:
+            return cls._get_many('''SELECT * FROM subjects''')
+        return subject_catalog.all()
 
 @register
 class SessionSubject(SingleKeyModel):
@@ -512,8 +926,8 @@ class SessionSubject(SingleKeyModel):
         FOREIGN KEY (subject_id) REFERENCES subjects(subject_id),
         UNIQUE (session_id, subject_id)
         )'''
-    _instances = weakref.WeakValueDictionary()
     _fields = ('ssid', 'seid', 'suid', 'is_open')
+    _converters = {'is_open': to_bool}
 
     @classmethod
     def create_for_session(cls, session, subjects):
@@ -526,7 +940,9 @@ class SessionSubject(SingleKeyModel):
                 cls._check_exists(Subject, subject)
         subjects = (s.sid if isinstance(s, Subject) else s for s in subjects)
         l = list(map(lambda x:(session, x, True), subjects))
-        return cls._insert_many('session_id, subject_id, ss_is_open', l)
+        r = cls._insert_many('session_id, subject_id, ss_is_open', l)
+        subject_catalog.invalidate()
+        return r
 
     @classmethod
     def all_subjects_for_session(cls, session):
@@ -534,10 +950,80 @@ class SessionSubject(SingleKeyModel):
             session = session.sid
         else:
             cls._check_exists(Session, session)
-        return Subject._get_many('''SELECT * FROM subjects
-                                    LEFT JOIN session_subjects USING (subject_id)
-                                    WHERE session_id IS NULL OR session_id=?''',
-                                   (session,))
+        return subject_catalog.for_session(session)
+
+
+class SubjectCatalog(object):
+    """In-memory copy of the `subjects` and `session_subjects` tables,
+    indexed by subject and by session.
+
+    It is loaded on first use, and loaded again after Subject.create and
+    SessionSubject.create_for_session, when it is more than `max_age`
+    seconds old, or when asked about a subject or a session it does not
+    know (as they may have been created by another process)."""
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self.invalidate()
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    def _load(self):
+        subjects = Subject._fetch_many('''SELECT * FROM subjects''')
+        links = SessionSubject._fetch_many('''SELECT session_id, subject_id
+                                              FROM session_subjects''')
+        sessions = Session._fetch_many('''SELECT session_id FROM sessions''')
+        by_id = {}
+        for row in subjects:
+            subject = Subject._from_row(row)
+            by_id[subject.sid] = subject
+        by_session = collections.defaultdict(set)
+        for (session, subject) in links:
+            by_session[session].add(by_id[subject])
+        linked = {x for (_, x) in links}
+        # Subjects of no session are offered for every session.
+        unlinked = frozenset(x for x in by_id.values() if x.sid not in linked)
+        (self._by_id, self._by_session, self._unlinked) = \
+                (by_id, dict(by_session), unlinked)
+        # Most sessions have no subject of their own: knowing them avoids
+        # loading the catalog again for each of them.
+        self._sessions = {x for (x,) in sessions} | set(by_session)
+        self._loaded_at = time.time()
+
+    def _check_loaded(self):
+        """Loads the catalog if needed, and returns whether it was."""
+        if self._loaded_at is None or \
+                time.time() - self._loaded_at > self.max_age:
+            self._load()
+            return True
+        return False
+
+    def get(self, sid):
+        just_loaded = self._check_loaded()
+        if sid not in self._by_id and not just_loaded:
+            self._load()
+        try:
+            return self._by_id[sid]
+        except KeyError:
+            raise NotFound()
+
+    def all(self):
+        self._check_loaded()
+        return set(self._by_id.values())
+
+    def all_permanent(self):
+        self._check_loaded()
+        return {x for x in self._by_id.values() if not x.is_exceptional}
+
+    def for_session(self, session):
+        just_loaded = self._check_loaded()
+        if session not in self._sessions and not just_loaded:
+            self._load()
+        # Loaded again only after max_age if it still does not exist.
+        self._sessions.add(session)
+        return self._unlinked | self._by_session.get(session, set())
+
+subject_catalog = SubjectCatalog(config.get('subject_catalog_max_age', 300))
 
 
 @register
@@ -552,7 +1038,6 @@ class TutorRegistrationSubject(SingleKeyModel):
         FOREIGN KEY (tregs_subject_id) REFERENCES subjects(subject_id),
         UNIQUE (tregs_treg_id, tregs_subject_id)
         )'''
-    _instances = weakref.WeakValueDictionary()
     _fields = ('id', 'trid', 'sid', 'preference')
 
     @classmethod
@@ -576,6 +1061,27 @@ class TutorRegistrationSubject(SingleKeyModel):
         return cls._get_many('''SELECT * FROM tutor_registrations_subject
                                 WHERE tregs_treg_id=?''', (treg,))
 
+    @classmethod
+    def all_in_session(cls, session):
+        if isinstance(session, Session):
+            session = session.sid
+        assert isinstance(session, int), session
+        return cls._get_many('''SELECT tutor_registrations_subject.*
+                                FROM tutor_registrations_subject
+                                INNER JOIN tutor_registrations
+                                    ON (tregs_treg_id=treg_id)
+                                WHERE session_id=?''', (session,))
+
+    @classmethod
+    def all_between(cls, start, end):
+        return cls._get_many('''SELECT tutor_registrations_subject.*
+                                FROM tutor_registrations_subject
+                                INNER JOIN tutor_registrations
+                                    ON (tregs_treg_id=treg_id)
+                                INNER JOIN sessions USING (session_id)
+                                WHERE session_date>=? AND session_date<?''',
+                             (start, end))
+
     @classmethod
     def set_for_treg(cls, treg, l):
         if isinstance(treg, TutorRegistration):
@@ -599,10 +1105,10 @@ class TutorRegistrationSubject(SingleKeyModel):
                              VALUES (?, ?, ?);''',
                           (treg, subject, preference))
         except sqlite3.IntegrityError:
-            conn.rollback()
+            _rollback(conn)
             raise Duplicate()
         else:
-            conn.commit()
+            _commit(conn)
         finally:
             c.close()
 
@@ -646,12 +1152,15 @@ class StudentRegistration(SingleKeyModel):
 
     @classmethod
     def get(cls, sid):
+        if not isinstance(sid, int):
+            raise ValueError('id should be or int, not %r' %
+                    sid)
+        instance = cls._instances.lookup(sid)
+        if instance is not None:
+            return instance
         conn = get_conn()
         c = conn.cursor()
         try:
-            if not isinstance(sid, int):
-                raise ValueError('id should be or int, not %r' %
-                        sid)
             c.execute('''SELECT * FROM student_registrations
                          WHERE sreg_id=?''',
                       (sid,))
@@ -668,6 +1177,14 @@ class StudentRegistration(SingleKeyModel):
         return cls._get_many('''SELECT * FROM student_registrations
                                 WHERE session_id=?''', (session,))
 
+    @classmethod
+    def all_between(cls, start, end):
+        return cls._get_many('''SELECT student_registrations.*
+                                FROM student_registrations
+                                INNER JOIN sessions USING (session_id)
+                                WHERE session_date>=? AND session_date<?''',
+                             (start, end))
+
     @classmethod
     def find(cls, session, student):
         if isinstance(session, Session):
@@ -703,10 +1220,62 @@ class StudentRegistration(SingleKeyModel):
                         subject_id=?, sreg_friends=?, sreg_comment=?
                         WHERE sreg_id=?''',
                      (subject, friends, comment, self.srid,))
-        conn.commit()
+        _commit(conn)
         self.subject = subject
         self.friends = friends
         self.comment = comment
+        self._instances.invalidate(self.srid)
+
+def from_json(value):
+    return None if value is None else json.loads(value)
+
+def to_json(value):
+    return json.dumps(value, separators=(',', ':'))
+
+@register
+class Mailing(SingleKeyModel):
+    """Subject and content templates shared by the mails of a mailing;
+    each mail only stores the values of the template's variables."""
+    _table = 'mailings'
+    _create_table = '''CREATE TABLE mailings (
+        mailing_id INTEGER PRIMARY KEY,
+        mailing_subject TEXT,
+        mailing_content TEXT,
+        mailing_variables TEXT,
+        mailing_created_at DATETIME
+        )'''
+    _cache_size = 16
+    _fields = ('mgid', 'subject', 'content', 'variables', 'created_at')
+    _converters = {'variables': from_json, 'created_at': to_datetime}
+
+    @classmethod
+    def create(cls, subject, content, variables):
+        """Raises mailmerge.TemplateError if the subject or the content
+        is not a valid template."""
+        mailmerge.MailTemplate(subject, content, variables)
+        return cls._insert_one('''mailing_subject, mailing_content,
+                                  mailing_variables, mailing_created_at''',
+                               (subject, content, to_json(list(variables)),
+                                datetime.datetime.now()))
+
+    @classmethod
+    def get(cls, mgid):
+        if not isinstance(mgid, int):
+            raise ValueError('id should be or int, not %r' %
+                    mgid)
+        instance = cls._instances.lookup(mgid)
+        if instance is not None:
+            return instance
+        r = cls._fetch_many('''SELECT * FROM mailings
+                               WHERE mailing_id=?''', (mgid,))
+        return cls._get_or_create(r[0] if r else None)
+
+    @property
+    def template(self):
+        if '_template' not in self.__dict__:
+            self._template = mailmerge.MailTemplate(self.subject,
+                    self.content, self.variables)
+        return self._template
 
 @register
 class Mail(SingleKeyModel):
@@ -716,24 +1285,60 @@ class Mail(SingleKeyModel):
         mail_recipient TEXT,
         mail_subject TEXT,
         mail_content TEXT,
-        mail_sent BOOLEAN
+        mail_sent BOOLEAN,
+        mail_attempts INTEGER NOT NULL DEFAULT 0,
+        mail_last_error TEXT,
+        mail_next_attempt DATETIME,
+        mail_sent_at DATETIME,
+        mail_mailing_id INTEGER REFERENCES mailings(mailing_id),
+        mail_variables TEXT
         )'''
-    _instances = weakref.WeakValueDictionary()
-    _fields = ('mid', 'recipient', 'subject', 'content', 'sent')
+    _fields = ('mid', 'recipient', 'subject', 'content', 'sent',
+            'attempts', 'last_error', 'next_attempt', 'sent_at',
+            'mailing_id', 'variables')
+    _converters = {'sent': to_bool, 'next_attempt': to_datetime,
+                   'sent_at': to_datetime, 'variables': from_json}
+    _columns = '''mail_recipient, mail_subject, mail_content, mail_sent,
+                  mail_attempts, mail_last_error, mail_next_attempt,
+                  mail_sent_at, mail_mailing_id, mail_variables'''
 
     @classmethod
-    def create(cls, recipient, content, sent=False):
-        return cls._insert_one('''mail_recipient, mail_subject, mail_content, mail_sent''',
-                               (recipient, content, sent))
+    def create(cls, recipient, subject, content, sent=False):
+        return cls._insert_one(cls._columns,
+                               (recipient, subject, content, sent,
+                                0, None, None, None, None, None))
 
     @classmethod
-    def create_many(cls, rows):
-        rows = [(x[0], x[1], x[2], x[3] if len(x) > 3 else False) for x in rows]
-        return cls._insert_many('''mail_recipient, mail_subject, mail_content, mail_sent''',
-                                rows)
+    def create_many(cls, rows, load=True):
+        rows = ((x[0], x[1], x[2], x[3] if len(x) > 3 else False,
+                 0, None, None, None, None, None)
+                for x in rows)
+        return cls._insert_many(cls._columns, rows, load=load)
+
+    @classmethod
+    def create_for_mailing(cls, mailing, rows, load=True):
+        """Queues a mail of the mailing for each (recipient, variables)
+        of `rows`, where `variables` is a dict of the values of the
+        mailing's variables."""
+        names = mailing.variables
+        rows = ((recipient, None, None, False, 0, None, None, None,
+                 mailing.mgid, to_json([variables[x] for x in names]))
+                for (recipient, variables) in rows)
+        return cls._insert_many(cls._columns, rows, load=load)
+
+    def render(self):
+        """Returns the subject and the content of the mail."""
+        if self.mailing_id is None:
+            return (self.subject, self.content)
+        mailing = Mailing.get(self.mailing_id)
+        return mailing.template.render(dict(zip(mailing.variables,
+                                                self.variables)))
 
     @classmethod
     def get(cls, mid):
+        instance = cls._instances.lookup(mid)
+        if instance is not None:
+            return instance
         conn = get_conn()
         c = conn.cursor()
         try:
@@ -749,10 +1354,231 @@ class Mail(SingleKeyModel):
     def all_unsent(cls):
         return cls._get_many('''SELECT * FROM mails WHERE mail_sent=0''')
 
+    @classmethod
+    def _iter_where(cls, condition, args, chunk_size):
+        """Yields the mails matching the condition by id, fetching
+        `chunk_size` of them at a time."""
+        # Each chunk is a separate query, rather than a cursor kept open
+        # across chunks, because committing on the connection (eg. to
+        # mark a mail as sent) would reset the cursor.
+        last_id = -1
+        while True:
+            r = cls._fetch_many('''SELECT * FROM mails
+                                   WHERE mail_id>? AND (%s)
+                                   ORDER BY mail_id LIMIT ?''' % condition,
+                                (last_id,) + tuple(args) + (chunk_size,))
+            for row in r:
+                yield cls._from_row(row)
+            if len(r) < chunk_size:
+                return
+            last_id = r[-1][0]
+
+    @classmethod
+    def iter_unsent(cls, chunk_size=100):
+        return cls._iter_where('mail_sent=0', (), chunk_size)
+
+    @classmethod
+    def iter_due(cls, max_attempts, now=None, chunk_size=100):
+        """Yields the unsent mails which were tried less than
+        `max_attempts` times and whose next attempt is due, by id."""
+        now = now or datetime.datetime.now()
+        return cls._iter_where('''mail_sent=0 AND mail_attempts<?
+                                  AND (mail_next_attempt IS NULL
+                                       OR mail_next_attempt<=?)''',
+                               (max_attempts, now), chunk_size)
+
+    @classmethod
+    def count_due(cls, max_attempts, now=None):
+        now = now or datetime.datetime.now()
+        return cls._fetch_many('''SELECT COUNT() FROM mails
+                                  WHERE mail_sent=0 AND mail_attempts<?
+                                  AND (mail_next_attempt IS NULL
+                                       OR mail_next_attempt<=?)''',
+                               (max_attempts, now))[0][0]
+
+    @classmethod
+    def next_attempt_time(cls, max_attempts):
+        """Returns when the next failed mail should be tried again, or
+        None."""
+        r = cls._fetch_many('''SELECT MIN(mail_next_attempt) FROM mails
+                               WHERE mail_sent=0 AND mail_attempts<?''',
+                            (max_attempts,))
+        return to_datetime(r[0][0])
+
+    @classmethod
+    def count_unsent(cls):
+        return cls._fetch_many('''SELECT COUNT() FROM mails
+                                  WHERE mail_sent=0''')[0][0]
+
+    @classmethod
+    def count_by_state(cls, max_attempts):
+        """Returns the number of unsent mails which were never tried,
+        which are to be tried again, and which were given up on."""
+        r = cls._fetch_many('''SELECT COALESCE(SUM(mail_attempts=0), 0),
+                                      COALESCE(SUM(mail_attempts>0
+                                                   AND mail_attempts<?), 0),
+                                      COALESCE(SUM(mail_attempts>=?), 0)
+                               FROM mails WHERE mail_sent=0''',
+                            (max_attempts, max_attempts))
+        return tuple(r[0])
+
     def set_sent(self):
+        self.set_sent_many([self])
+
+    @classmethod
+    def set_sent_many(cls, mails, chunk_size=500):
+        """Marks the mails as sent, with one statement per `chunk_size`
+        mails, in a single transaction."""
+        now = datetime.datetime.now()
+        mails = list(mails)
+        conn = get_conn()
+        c = conn.cursor()
+        try:
+            for i in range(0, len(mails), chunk_size):
+                chunk = mails[i:i+chunk_size]
+                c.execute('''UPDATE mails SET mail_sent=1,
+                             mail_attempts=mail_attempts+1, mail_sent_at=?
+                             WHERE mail_id IN (%s)''' %
+                          ', '.join('?'*len(chunk)),
+                          [now] + [x.mid for x in chunk])
+        finally:
+            c.close()
+        _commit(conn)
+        for mail in mails:
+            mail.sent = True
+            mail.attempts += 1
+            mail.sent_at = now
+            cls._instances.invalidate(mail.mid)
+
+    @classmethod
+    def claim_many(cls, mails, until, now=None, chunk_size=500):
+        """Sets the next attempt of the mails which are still due to
+        `until`, so other workers skip them until then, with two
+        statements per `chunk_size` mails in a single transaction.
+
+        Returns the claimed mails; the others were claimed, tried or sent
+        by another worker since they were fetched. A mail which was tried
+        since it was fetched stays claimed until `until`, then is sent by
+        the next drain. Each call must use a different `until`, which
+        tells the mails it claimed."""
+        now = now or datetime.datetime.now()
+        mails = list(mails)
+        r = []
         conn = get_conn()
-        conn.execute('''UPDATE mails SET mail_sent=1
+        c = conn.cursor()
+        try:
+            for i in range(0, len(mails), chunk_size):
+                chunk = mails[i:i+chunk_size]
+                ids = ', '.join('?'*len(chunk))
+                c.execute('''UPDATE mails SET mail_next_attempt=?
+                             WHERE mail_id IN (%s) AND mail_sent=0
+                             AND (mail_next_attempt IS NULL
+                                  OR mail_next_attempt<=?)''' % ids,
+                          [until] + [x.mid for x in chunk] + [now])
+                c.execute('''SELECT mail_id, mail_attempts FROM mails
+                             WHERE mail_id IN (%s)
+                             AND mail_next_attempt=?''' % ids,
+                          [x.mid for x in chunk] + [until])
+                claimed = set(c.fetchall())
+                r.extend(x for x in chunk if (x.mid, x.attempts) in claimed)
+        finally:
+            c.close()
+        _commit(conn)
+        for mail in r:
+            mail.next_attempt = until
+            cls._instances.invalidate(mail.mid)
+        return r
+
+    def set_failed(self, error, next_attempt):
+        """Records a failed attempt; `next_attempt` is None if the mail
+        should not be tried again."""
+        conn = get_conn()
+        conn.execute('''UPDATE mails SET mail_attempts=mail_attempts+1,
+                        mail_last_error=?, mail_next_attempt=?
                         WHERE mail_id=?''',
-                     (self.mid,))
-        conn.commit()
-        self.sent = True
+                     (error, next_attempt, self.mid,))
+        _commit(conn)
+        self.attempts += 1
+        self.last_error = error
+        self.next_attempt = next_attempt
+        self._instances.invalidate(self.mid)
+
+@register
+class ImportJob(SingleKeyModel):
+    """Import of a contacts file, run in the background (see importjobs)."""
+    _table = 'import_jobs'
+    _create_table = '''CREATE TABLE import_jobs (
+        job_id INTEGER PRIMARY KEY,
+        job_path TEXT,
+        job_state TEXT,
+        job_nb_rows INTEGER NOT NULL DEFAULT 0,
+        job_nb_imported INTEGER NOT NULL DEFAULT 0,
+        job_nb_ignored INTEGER NOT NULL DEFAULT 0,
+        job_error TEXT,
+        job_created_at DATETIME,
+        job_updated_at DATETIME
+        )'''
+    _fields = ('jid', 'path', 'state', 'nb_rows', 'nb_imported',
+            'nb_ignored', 'error', 'created_at', 'updated_at')
+    _converters = {'created_at': to_datetime, 'updated_at': to_datetime}
+
+    STATES = ('pending', 'running', 'done', 'failed')
+
+    @classmethod
+    def create(cls, path):
+        now = datetime.datetime.now()
+        return cls._insert_one('''job_path, job_state, job_nb_rows,
+                                  job_nb_imported, job_nb_ignored, job_error,
+                                  job_created_at, job_updated_at''',
+                               (path, 'pending', 0, 0, 0, None, now, now))
+
+    @classmethod
+    def get(cls, jid):
+        if not isinstance(jid, int):
+            raise ValueError('id should be or int, not %r' %
+                    jid)
+        instance = cls._instances.lookup(jid)
+        if instance is not None:
+            return instance
+        r = cls._fetch_many('''SELECT * FROM import_jobs
+                               WHERE job_id=?''', (jid,))
+        return cls._get_or_create(r[0] if r else None)
+
+    def _update(self, values):
+        values = dict(values, updated_at=datetime.datetime.now())
+        conn = get_conn()
+        conn.execute('UPDATE import_jobs SET %s WHERE job_id=?' %
+                     ', '.join('job_%s=?' % x for x in values),
+                     tuple(values.values()) + (self.jid,))
+        _commit(conn)
+        for (name, value) in values.items():
+            setattr(self, name, value)
+        self._instances.invalidate(self.jid)
+
+    def set_state(self, state, error=None):
+        assert state in self.STATES, state
+        self._update({'state': state, 'error': error})
+
+    def set_progress(self, nb_rows, nb_imported, nb_ignored):
+        self._update({'nb_rows': nb_rows, 'nb_imported': nb_imported,
+                      'nb_ignored': nb_ignored})
+
+    def is_interrupted(self, now=None):
+        """Returns whether the job is pending or running but was not
+        updated for "import_timeout" seconds (300 by default), eg. because
+        the process running it exited."""
+        now = now or datetime.datetime.now()
+        timeout = datetime.timedelta(seconds=config.get('import_timeout', 300))
+        return self.state in ('pending', 'running') and \
+                now - self.updated_at > timeout
+
+    def status(self, now=None):
+        """Returns the job's progress; the state of an interrupted job
+        is "interrupted"."""
+        return {'state': 'interrupted' if self.is_interrupted(now)
+                         else self.state,
+                'nb_rows': self.nb_rows,
+                'nb_imported': self.nb_imported,
+                'nb_ignored': self.nb_ignored,
+                'error': self.error,
+                }
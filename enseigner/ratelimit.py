@@ -0,0 +1,156 @@
+"""Sliding window rate limiting, used to throttle login attempts before
+they reach the model."""
+import time
+import threading
+
+import model
+from config import config
+
+class MemoryStore(object):
+    """Counters kept in the memory of the process."""
+    def __init__(self, purge_interval=60):
+        self.purge_interval = purge_interval
+        self._data = {}
+        self._next_purge = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, now):
+        """Returns the counters of the key, as a {bucket: count} dict."""
+        with self._lock:
+            (expires, counts) = self._data.get(key, (0, {}))
+            return dict(counts) if expires > now else {}
+
+    def incr(self, key, bucket, now, expires):
+        """Increments a counter of the key, and forgets the key's older
+        buckets. The key can be forgotten after `expires`."""
+        with self._lock:
+            if now >= self._next_purge:
+                self._data = {k: v for (k, v) in self._data.items()
+                              if v[0] > now}
+                self._next_purge = now + self.purge_interval
+            (old_expires, counts) = self._data.get(key, (0, {}))
+            counts = {b: c for (b, c) in counts.items()
+                      if b >= bucket - 1 and old_expires > now}
+            counts[bucket] = counts.get(bucket, 0) + 1
+            self._data[key] = (expires, counts)
+
+    def reset(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+class SQLiteStore(object):
+    """Counters kept in the `rate_limits` table of the database, shared by
+    all processes of the application."""
+    _create_table = '''CREATE TABLE IF NOT EXISTS rate_limits (
+        rl_key TEXT,
+        rl_bucket INTEGER,
+        rl_count INTEGER,
+        rl_expires REAL,
+        PRIMARY KEY (rl_key, rl_bucket)
+        )'''
+
+    def __init__(self, purge_interval=60):
+        self.purge_interval = purge_interval
+        self._next_purge = 0
+        self._created = False
+
+    def _conn(self):
+        conn = model.get_conn()
+        if not self._created:
+            conn.execute(self._create_table)
+            self._created = True
+        return conn
+
+    def _commit(self, conn):
+        if not model.in_transaction():
+            conn.commit()
+
+    def get(self, key, now):
+        r = self._conn().execute('''SELECT rl_bucket, rl_count
+                                    FROM rate_limits
+                                    WHERE rl_key=? AND rl_expires>?''',
+                                 (key, now)).fetchall()
+        return dict(r)
+
+    def incr(self, key, bucket, now, expires):
+        conn = self._conn()
+        if now >= self._next_purge:
+            conn.execute('DELETE FROM rate_limits WHERE rl_expires<=?',
+                         (now,))
+            self._next_purge = now + self.purge_interval
+        conn.execute('''DELETE FROM rate_limits
+                        WHERE rl_key=? AND rl_bucket<?''', (key, bucket - 1))
+        conn.execute('''INSERT OR IGNORE INTO rate_limits
+                        VALUES (?, ?, 0, ?)''', (key, bucket, expires))
+        conn.execute('''UPDATE rate_limits
+                        SET rl_count=rl_count+1, rl_expires=?
+                        WHERE rl_key=? AND rl_bucket=?''',
+                     (expires, key, bucket))
+        self._commit(conn)
+
+    def reset(self, key):
+        conn = self._conn()
+        conn.execute('DELETE FROM rate_limits WHERE rl_key=?', (key,))
+        self._commit(conn)
+
+class SlidingWindow(object):
+    """Allows about `limit` hits per key in any `window` seconds.
+
+    Hits are counted per bucket of `window` seconds; the count of the
+    previous bucket is weighted by the part of it which is still in the
+    sliding window. Each key only needs two counters."""
+    def __init__(self, limit, window, store):
+        self.limit = limit
+        self.window = float(window)
+        self.store = store
+
+    def count(self, key, now=None):
+        """Returns the estimated number of hits in the last `window`
+        seconds."""
+        now = now or time.time()
+        (bucket, elapsed) = divmod(now, self.window)
+        bucket = int(bucket)
+        counts = self.store.get(key, now)
+        return counts.get(bucket - 1, 0) * (1 - elapsed / self.window) + \
+                counts.get(bucket, 0)
+
+    def hit(self, key, now=None):
+        """Records a hit and returns True, or returns False (recording
+        nothing) if the key already reached the limit."""
+        now = now or time.time()
+        if self.count(key, now) >= self.limit:
+            return False
+        bucket = int(now // self.window)
+        self.store.incr(key, bucket, now, (bucket + 2) * self.window)
+        return True
+
+    def reset(self, key):
+        self.store.reset(key)
+
+class LoginThrottle(object):
+    """Limits login attempts per IP address and per email.
+
+    `throttle_config` defaults to the "login_throttling" section of the
+    configuration: "per_ip" and "per_email" are [limit, window] pairs, and
+    "store" is "memory" (the default) or "sqlite", to share the counters
+    between processes."""
+    def __init__(self, throttle_config=None):
+        if throttle_config is None:
+            throttle_config = config.get('login_throttling', {})
+        if throttle_config.get('store', 'memory') == 'sqlite':
+            store = SQLiteStore()
+        else:
+            store = MemoryStore()
+        (limit, window) = throttle_config.get('per_ip', (20, 60))
+        self.per_ip = SlidingWindow(limit, window, store)
+        (limit, window) = throttle_config.get('per_email', (10, 300))
+        self.per_email = SlidingWindow(limit, window, store)
+
+    def allow(self, ip, email, now=None):
+        """Records an attempt, and returns whether it may proceed."""
+        return self.per_ip.hit('ip:%s' % ip, now) and \
+                self.per_email.hit(u'email:%s' % email.lower(), now)
+
+    def succeeded(self, email):
+        """Forgets the attempts on the email after a successful login."""
+        self.per_email.reset(u'email:%s' % email.lower())
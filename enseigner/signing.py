@@ -0,0 +1,76 @@
+"""Signatures of the parameters of subscription form links, so only the
+recipient of a link can use it."""
+import hmac
+import time
+import hashlib
+
+def legacy_signature(secret, session_id, type_, user_id):
+    """Signature of the links sent before LinkSigner was used."""
+    return hashlib.sha256('%s|%s|%s|%s' % (secret, type_, session_id, user_id))\
+            .hexdigest()
+
+class LinkSigner(object):
+    """Signs (session, type, user) triples with HMAC-SHA256.
+
+    The key is processed once; each signature starts from a copy of the
+    keyed state. A signature can have an expiry date, which is part of
+    the token: "<expiry in hex>-<mac>". If `accept_legacy` is true, tokens
+    of legacy_signature() are accepted too."""
+    def __init__(self, secret, accept_legacy=True):
+        assert len(secret) >= 20, 'Secret is not long enough'
+        self._secret = secret
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf8')
+        self._hmac = hmac.new(secret, digestmod=hashlib.sha256)
+        self.accept_legacy = accept_legacy
+
+    def _prefix(self, session_id, type_):
+        assert type_ in ('tutor', 'student'), type_
+        h = self._hmac.copy()
+        h.update('%s|%s|' % (type_, session_id))
+        return h
+
+    @staticmethod
+    def _token(prefix, user_id, expires):
+        h = prefix.copy()
+        h.update('%s|%s' % (user_id, expires or ''))
+        mac = h.hexdigest()[:32]
+        return mac if expires is None else '%x-%s' % (expires, mac)
+
+    def sign(self, session_id, type_, user_id, expires=None):
+        """Returns the token of the link; `expires` is a timestamp."""
+        return self._token(self._prefix(session_id, type_), user_id,
+                           None if expires is None else int(expires))
+
+    def sign_many(self, session_id, type_, user_ids, expires=None):
+        """Returns a {user_id: token} dict of the links of a session for
+        all the users, eg. for a mailing."""
+        prefix = self._prefix(session_id, type_)
+        expires = None if expires is None else int(expires)
+        return {x: self._token(prefix, x, expires) for x in user_ids}
+
+    def verify(self, token, session_id, type_, user_id, now=None):
+        """Returns whether the token is valid for these parameters and has
+        not expired. The comparison takes constant time."""
+        try:
+            token = str(token)
+        except UnicodeError:
+            return False
+        if '-' in token:
+            (expires, mac) = token.split('-', 1)
+            try:
+                expires = int(expires, 16)
+            except ValueError:
+                return False
+            if expires < (now or time.time()):
+                return False
+        else:
+            expires = None
+        expected = self.sign(session_id, type_, user_id, expires)
+        if hmac.compare_digest(expected, token):
+            return True
+        return self.accept_legacy and expires is None and \
+                hmac.compare_digest(legacy_signature(self._secret,
+                                                     session_id, type_,
+                                                     user_id),
+                                    token)
@@ -1,18 +1,23 @@
 # -*- coding: utf8 -*-
 import os
 import sys
+import time
 import uuid
-import odswriter
+import datetime
 import collections
-from cStringIO import StringIO
 from flask import Flask, render_template, request, session, redirect, url_for
-from flask import abort, Response
+from flask import abort, jsonify, stream_with_context, g
 from werkzeug.exceptions import HTTPException
 from werkzeug.wrappers import Response
 
 import model
+import export
 import emails
 import controller
+import mailqueue
+import mailmerge
+import ratelimit
+import importjobs
 from config import config
 
 app = Flask('enseigner')
@@ -21,6 +26,18 @@ app.root_path = os.path.join(os.path.dirname(__file__), '..')
 salt = config['password_salt']
 assert len(salt) >= 20, 'Secret key is not long enough'
 app.secret_key = salt
+login_throttle = ratelimit.LoginThrottle()
+
+@app.teardown_appcontext
+def release_db_conn(exception):
+    model.release_conn()
+
+@app.before_first_request
+def start_mail_worker():
+    # Sends the mails queued or to be tried again before the application
+    # (re)started, without waiting for a new mailing.
+    if not app.testing:
+        mailqueue.start()
 
 TUTORS_EMAIL_SUBJECT = u'ENSeigner — Participation à la séance du %(date)s'
 TUTORS_EMAIL_CONTENT = u'''Bonjour $nom_tuteur,
@@ -48,21 +65,58 @@ class AdminOnly(HTTPException):
                 error_message=u'Accès réservé aux responsables du soutien.')
         return Response(html, mimetype='text/html')
 
+def current_tutor(cached=True):
+    """Returns the logged in tutor, or None. The tutor is looked up once
+    per request, or from the database if `cached` is false."""
+    if not hasattr(g, 'tutor') or not cached:
+        g.tutor = None
+        id = session.get('tutor_id', None)
+        if id:
+            try:
+                g.tutor = model.Tutor.get(id, cached)
+            except model.NotFound:
+                pass
+    return g.tutor
+
+def remember_auth(tutor):
+    """Caches the admin status of the tutor in the session cookie, which
+    is signed."""
+    session['tutor_id'] = tutor.uid
+    session['auth'] = (tutor.uid, tutor.is_admin, int(time.time()),
+                       config.get('auth_version', 0))
+
+def is_admin():
+    """Returns whether the logged in tutor is an admin, or None if no
+    tutor is logged in.
+
+    The answer cached in the session is used for "auth_cache_ttl" seconds
+    (300 by default); changing "auth_version" in the configuration
+    invalidates it in every session."""
+    id = session.get('tutor_id', None)
+    auth = session.get('auth', None)
+    if id and auth and auth[0] == id and \
+            auth[3] == config.get('auth_version', 0) and \
+            0 <= time.time() - auth[2] < config.get('auth_cache_ttl', 300):
+        return auth[1]
+    # Not from the identity map, which could keep the tutor's former
+    # status for as long as the process runs.
+    tutor = current_tutor(cached=False)
+    if tutor is None:
+        session.pop('auth', None)
+        return None
+    remember_auth(tutor)
+    return tutor.is_admin
+
 def require_admin(f):
     def newf(**kwargs):
-        try:
-            id = session.get('tutor_id', None)
-            if not id:
-                raise model.NotFound()
-            tutor = model.Tutor.get(id)
-        except model.NotFound:
+        admin = is_admin()
+        if admin is None:
             url = url_for(f.__name__, **kwargs).lstrip('/')
             return redirect(url_for('connexion', redirect_url=url))
+        elif admin:
+            return f(**kwargs)
         else:
-            if tutor.is_admin:
-                return f(**kwargs)
-            else:
-                raise AdminOnly()
+            raise AdminOnly()
     newf.__name__ = f.__name__
     return newf
 
@@ -96,7 +150,7 @@ def prochaines_seances():
 @require_admin
 def gestion_soutien():
     return render_template('gestion_soutien/index.html',
-            sessions=model.Session.all())
+            sessions=model.Session.all_with_counts())
 
 @app.route('/gestion_soutien/liste_tuteurs_seance/')
 @require_admin
@@ -105,29 +159,53 @@ def liste_tuteurs_seance():
     rows = controller.get_tutor_registration_list_rows(session)
 
     if request.args.get('download', 'false') == 'true':
-        def pred(row):
-            return (
-                    row.tutor.name,
-                    row.tutor.email,
-                    ', '.join(x.name for x in row.subjects1),
-                    ', '.join(x.name for x in row.subjects2),
-                    row.comment)
-        io = StringIO()
-        with odswriter.writer(io) as odsfile:
-            odsfile.writerow(['Nom', 'Email', u'Matière principale',
-                u'Autres matières', 'Commentaire', 'Confirmation'])
-            for row in rows:
-                odsfile.writerow(pred(row))
-        io.seek(0)
-        response = Response(io,
-                mimetype='application/vnd.oasis.opendocument.spreadsheet')
-        response.headers["Content-Disposition"] = "attachment; filename=Tuteurs_seance.ods"
+        cells = controller.tutor_registration_list_cells(rows)
+        if request.args.get('format', 'ods') == 'csv':
+            response = Response(stream_with_context(export.to_csv(cells)),
+                    mimetype='text/csv; charset=utf-8')
+            filename = 'Tuteurs_seance.csv'
+        else:
+            response = Response(
+                    stream_with_context(export.to_ods([('Tuteurs', cells)])),
+                    mimetype='application/vnd.oasis.opendocument.spreadsheet')
+            filename = 'Tuteurs_seance.ods'
+        response.headers["Content-Disposition"] = "attachment; filename=%s" % filename
         return response
     else:
         return render_template('gestion_soutien/liste_tuteurs_seance.html',
                 session=session,
                 rows=rows)
 
+@app.route('/gestion_soutien/export/')
+@require_admin
+def export_seances():
+    invalid = set()
+    dates = {}
+    if 'download' in request.args:
+        for x in ('start', 'end'):
+            try:
+                dates[x] = controller.parse_human_day(request.args.get(x, ''))
+            except ValueError:
+                invalid.add(x)
+    if 'download' not in request.args or invalid:
+        return render_template('gestion_soutien/export.html',
+                invalid=invalid,
+                form=request.args)
+    sheets = controller.export_sessions(dates['start'],
+            dates['end'] + datetime.timedelta(days=1))
+    filename = 'Seances_%s_%s' % (dates['start'].strftime('%Y-%m-%d'),
+                                  dates['end'].strftime('%Y-%m-%d'))
+    if request.args.get('format', 'ods') == 'csv':
+        response = Response(stream_with_context(export.to_csv_zip(sheets)),
+                mimetype='application/zip')
+        filename += '.zip'
+    else:
+        response = Response(stream_with_context(export.to_ods(sheets)),
+                mimetype='application/vnd.oasis.opendocument.spreadsheet')
+        filename += '.ods'
+    response.headers["Content-Disposition"] = "attachment; filename=%s" % filename
+    return response
+
 @app.route('/gestion_soutien/nouvelle/', methods=['GET', 'POST'])
 @require_admin
 def nouvelle_seance():
@@ -161,23 +239,25 @@ def mail_get_invalid():
 def envoi_mail_tuteurs():
     session = model.Session.get(int(request.args['session']))
     invalid = mail_get_invalid()
+    errors = []
     if request.method == 'POST' and not invalid:
         subject = request.form['subject']
         content = request.form['content']
-        def get_form_url(tutor):
-            key = controller.hash_subscription_params(session.sid, 'tutor', tutor.uid)
+        def get_form_url(tutor, key):
             return url_for('formulaire_tuteur', _external=True,
                     session=session.sid,
                     tuteur=tutor.uid,
                     key=key
                     )
-        errors = controller.send_tutor_email(session, get_form_url, subject, content)
-        if not errors:
+        try:
+            controller.send_tutor_email(session, get_form_url, subject, content)
+        except mailmerge.TemplateError as e:
+            errors.append(e.args[0])
+        else:
+            mailqueue.notify()
             return redirect(url_for('gestion_soutien'))
     elif request.method == 'POST':
-        errors = ['Un ou des champs est/sont invalide-s']
-    else:
-        errors = []
+        errors.append('Un ou des champs est/sont invalide-s')
 
     subj_repl = {'date': session.date.strftime('%d/%m/%Y')}
     subject = request.form.get('subject', '') or \
@@ -191,6 +271,11 @@ def envoi_mail_tuteurs():
                            errors=errors,
                            invalid=invalid)
         
+@app.route('/gestion_soutien/envoi_mail/etat/')
+@require_admin
+def etat_envoi_mails():
+    return jsonify(mailqueue.worker.status())
+
 @app.route('/gestion_soutien/envoi_mail_seance/eleves/', methods=['GET', 'POST'])
 def envoi_mail_eleves():
     session = model.Session.get(int(request.args['session']))
@@ -218,13 +303,18 @@ def connexion():
         password = request.form.get('password', None)
         redirect_url = request.form.get('redirect_url', '')
         assert email and password, request.form
+        if not login_throttle.allow(request.remote_addr, email):
+            return render_template('connexion.html',
+                    redirect_url=redirect_url,
+                    throttled=True), 429
         tutor = model.Tutor.check_password(email, password)
         if not tutor:
             return render_template('connexion.html',
                     redirect_url=redirect_url,
                     wrong_login=True)
         else:
-            session['tutor_id'] = tutor.uid
+            login_throttle.succeeded(email)
+            remember_auth(tutor)
             return redirect('/' + redirect_url)
     else:
         raise AssertionError(request.method)
@@ -268,9 +358,19 @@ def importer_tuteurs():
     if request.method == 'GET':
         return render_template('gestion_contacts/import.html')
     else:
-        (nb_imported, nb_ignored) = \
-                controller.import_tutors(request.files['file'].stream)
-        return redirect(url_for('gestion_tuteurs',
-            confirmation_import=1,
-            nb_imports=nb_imported,
-            nb_ignores=nb_ignored))
+        job = importjobs.spool(request.files['file'].stream)
+        importjobs.start(job)
+        return redirect(url_for('progression_import_tuteurs', job=job.jid))
+
+@app.route('/gestion_contacts/tuteurs/import/progression/')
+@require_admin
+def progression_import_tuteurs():
+    job = model.ImportJob.get(int(request.args['job']))
+    return render_template('gestion_contacts/import_progression.html',
+            job=job)
+
+@app.route('/gestion_contacts/tuteurs/import/etat/')
+@require_admin
+def etat_import_tuteurs():
+    job = model.ImportJob.get(int(request.args['job']))
+    return jsonify(job.status())
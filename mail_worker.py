@@ -0,0 +1,7 @@
+#!/usr/bin/env python2
+# Sends queued mails continuously. Use it with "worker": "process" in the
+# "email" section of the configuration, so the web application does not
+# send mails itself.
+import enseigner.mailqueue as mailqueue
+
+mailqueue.Worker().run_forever()
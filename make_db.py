@@ -3,6 +3,7 @@
 import csv
 import sys
 import enseigner.model as model
+import enseigner.migrations as migrations
 
 SUBJECTS = u'''
 Mathématiques
@@ -26,6 +27,9 @@ conn = model.get_conn()
 with conn:
     for table in model.tables:
         conn.execute(table._create_table)
+# The tables are already up to date; this adds the indexes and records
+# the schema version.
+migrations.upgrade(conn)
 
 for subject in filter(bool, SUBJECTS.split('\n')):
     model.Subject.create(subject, False)
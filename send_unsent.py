@@ -1,28 +1,19 @@
 #!/usr/bin/env python2
 # -*- coding: utf8 -*-
-import smtplib
 import enseigner.model as model
-import enseigner.emails as emails
+import enseigner.mailqueue as mailqueue
 
-mails = model.Mail.all_unsent()
+worker = mailqueue.Worker()
+nb_mails = model.Mail.count_due(worker.max_attempts)
 
-yesno = raw_input(u'Envoyer %d mails ? ' % len(mails))
+yesno = raw_input(u'Envoyer %d mails ? ' % nb_mails)
 
 if yesno != 'yes':
     exit(0)
 
-sender = emails.Sender()
-errors = []
-for mail in mails:
-    try:
-        sender.send(mail.recipient, mail.subject, mail.content)
-    except smtplib.SMTPException as e:
-        errors.append((mail, e))
-    else:
-        mail.set_sent()
+errors = worker.drain()
+worker.close()
 
+# Failed mails are recorded in the database, and tried again later by
+# the worker.
 print(repr(errors))
-with open('/tmp/enseigner_errors.txt', 'a') as fd:
-    for error in errors:
-        fd.write('\n\n')
-        fd.write(repr(error))
@@ -1,9 +1,11 @@
-import smtplib
+# -*- coding: utf8 -*-
+from cStringIO import StringIO
 
 from testutils import EnseignerTestCase
 
 import enseigner.model as model
 import enseigner.emails as emails
+import enseigner.mailmerge as mailmerge
 import enseigner.controller as controller
 
 class ControllerTestCase(EnseignerTestCase):
@@ -52,6 +54,46 @@ class ControllerTestCase(EnseignerTestCase):
         self.assertEqual(group_size, 4)
         self.assertEqual(comment, 'quux')
 
+    def testTutorRegistrationListRows(self):
+        sub1 = model.Subject.create('foo', False)
+        sub2 = model.Subject.create('bar', False)
+        s1 = controller.create_session('26/12/2014 20:50', ['baz'])
+        sub3 = [x for x in model.SessionSubject.all_subjects_for_session(s1) if x.name == 'baz'][0]
+        def register(i):
+            t = model.Tutor.create('foo%d' % i, 'bar%d' % i, 'baz', False)
+            h = controller.hash_subscription_params(s1.sid, 'tutor', t.uid)
+            controller.set_tutor_form_data(str(s1.sid), str(t.uid), h,
+                    [(str(sub2.sid), 1), (str(sub1.sid), 2), (str(sub3.sid), 2)],
+                    3, 'qux%d' % i)
+            return t
+        t1 = register(1)
+        t2 = register(2)
+        with self.count_queries() as conn:
+            rows = controller.get_tutor_registration_list_rows(s1)
+        nb_queries = conn.nb_queries
+        self.assertEqual(len(rows), 2)
+        self.assertEqual({x.tutor for x in rows}, {t1, t2})
+        for row in rows:
+            self.assertEqual(row.subjects1, [sub2])
+            self.assertEqual(set(row.subjects2), {sub1, sub3})
+        self.assertEqual({x.comment for x in rows}, {'qux1', 'qux2'})
+
+        for i in range(3, 20):
+            register(i)
+        with self.count_queries() as conn:
+            rows = controller.get_tutor_registration_list_rows(s1)
+        self.assertEqual(len(rows), 19)
+        self.assertEqual(conn.nb_queries, nb_queries)
+
+    def testTutorSubscriptionRollback(self):
+        sub1 = model.Subject.create('foo', False)
+        t1 = model.Tutor.create('foo', 'bar', 'baz', False)
+        s1 = controller.create_session('26/12/2014 20:50', [])
+        h = controller.hash_subscription_params(s1.sid, 'tutor', t1.uid)
+        self.assertRaises(model.NotFound, controller.set_tutor_form_data,
+                str(s1.sid), str(t1.uid), h, [(str(sub1.sid), 1), ('1000', 2)], 3, 'qux')
+        self.assertRaises(model.NotFound, model.TutorRegistration.find, s1, t1)
+
     def testStudentSubscription(self):
         sub1 = model.Subject.create('foo', False)
         sub2 = model.Subject.create('bar', True)
@@ -84,31 +126,96 @@ class ControllerTestCase(EnseignerTestCase):
         self.assertEqual(friends, 4)
         self.assertEqual(comment, 'quux')
 
-    def testSendTutorEmailSuccess(self):
+    def testSendTutorEmail(self):
         s1 = controller.create_session('28/12/2014 12:17', [])
         t1 = model.Tutor.create('foo', 'bar', 'baz', False)
         t2 = model.Tutor.create('foo2', 'bar2', 'baz', False)
-        self.assertEqual(controller.send_tutor_email(s1, lambda x:'f', 'toto', 'titi $nom_tuteur'), [])
-        self.assertEqual(set(emails.MockSender.queue), {
+        self.assertFalse(s1.emailed_tutors)
+        self.assertEqual(controller.send_tutor_email(s1, lambda x, y: 'f', 'toto', 'titi $nom_tuteur'), 2)
+        self.assertTrue(s1.emailed_tutors)
+        self.assertEqual(emails.MockSender.queue, [])
+        self.assertEqual({(x.recipient,) + x.render()
+                          for x in model.Mail.all_unsent()}, {
             ('foo', 'toto', 'titi bar'),
             ('foo2', 'toto', 'titi bar2')
             })
 
-    def testSendTutorEmailError(self):
+    def testSendTutorEmailInvalidTemplate(self):
         s1 = controller.create_session('28/12/2014 12:17', [])
-        t1 = model.Tutor.create('foo', 'bar', 'baz', False)
-        t2 = model.Tutor.create('foo2', 'bar2', 'baz', False)
-        errored = set()
-        original_send = emails.MockSender.send
-        def fakesend(self, recipient, subject, content):
-            errored.add((recipient, subject, content))
-            emails.MockSender.send = original_send
-            raise smtplib.SMTPException()
-        emails.MockSender.send = fakesend
-        errors = controller.send_tutor_email(s1, lambda x:'f', 'toto', 'titi $nom_tuteur')
-        self.assertEqual(len(errors), 1, errors)
-        self.assertTrue(errored)
-        self.assertEqual(set(emails.MockSender.queue), {
-            ('foo', 'toto', 'titi bar'),
-            ('foo2', 'toto', 'titi bar2')
-            } - errored)
+        model.Tutor.create('foo', 'bar', 'baz', False)
+        self.assertRaises(mailmerge.TemplateError, controller.send_tutor_email,
+                s1, lambda x, y: 'f', 'toto', 'titi $nom_eleve')
+        self.assertFalse(s1.emailed_tutors)
+        self.assertEqual(model.Mail.count_unsent(), 0)
+
+    def testImportTutors(self):
+        model.Tutor.create('foo3@example.org', 'Foo 3')
+        fd = StringIO('First Name,Last Name,E-mail Address\n' +
+                ''.join('Foo,%d,foo%d@example.org\n' % (i, i)
+                        for i in range(10)) +
+                'Bar,\xe9,foo2@example.org\n')
+        with self.count_queries() as conn:
+            self.assertEqual(controller.import_tutors(fd, chunk_size=4),
+                    (9, 2))
+        # One lookup and one insert per chunk
+        self.assertEqual(conn.nb_queries, 6)
+        self.assertEqual(len(model.Tutor.all()), 10)
+        self.assertEqual(model.Tutor.get('foo2@example.org').name, 'Foo 2')
+        self.assertEqual(model.Tutor.get('foo3@example.org').name, 'Foo 3')
+        self.assertTrue(model.Tutor.get('foo9@example.org').is_active)
+        self.assertEqual(controller.import_tutors(StringIO('')), (0, 0))
+
+    def testExportSessions(self):
+        sub1 = model.Subject.create('foo', False)
+        sub2 = model.Subject.create('bar', False)
+        sessions = [controller.create_session('%02d/01/2015 14:00' % i, [])
+                    for i in (3, 10, 17)]
+        t1 = model.Tutor.create('foo1', 'bar1')
+        t2 = model.Tutor.create('foo2', 'bar2')
+        st1 = model.Student.create('qux1', 'quux1')
+        for session in sessions:
+            treg = model.TutorRegistration.create(session, t1, 2, 'corge')
+            model.TutorRegistrationSubject.set_for_treg(treg,
+                    [(sub1, 1), (sub2, 2)])
+            model.StudentRegistration.create(session, st1, sub2, 1, 'grault')
+        model.TutorRegistration.create(sessions[2], t2, 3, '')
+        start = controller.parse_human_day('10/01/2015')
+        end = controller.parse_human_day('18/01/2015')
+        with self.count_queries() as conn:
+            sheets = dict(controller.export_sessions(start, end))
+            sheets = {x: list(y) for (x, y) in sheets.items()}
+        nb_queries = conn.nb_queries
+        self.assertEqual(sheets[u'Séances'][1:], [
+            (sessions[1].date, 1, 1), (sessions[2].date, 2, 1)])
+        self.assertEqual([x[0] for x in sheets['Tuteurs'][1:]],
+                         ['bar1', 'bar2'])
+        self.assertEqual(sheets['Inscriptions tuteurs'][1:], [
+            (sessions[1].date, 'bar1', 'foo1', 'foo', 'bar', 2, 'corge'),
+            (sessions[2].date, 'bar1', 'foo1', 'foo', 'bar', 2, 'corge'),
+            (sessions[2].date, 'bar2', 'foo2', '', '', 3, ''),
+            ])
+        self.assertEqual(sheets[u'Inscriptions élèves'][1:], [
+            (sessions[1].date, 'quux1', 'bar', 1, 'grault'),
+            (sessions[2].date, 'quux1', 'bar', 1, 'grault'),
+            ])
+        self.assertEqual(len(sheets[u'Élèves']), 2)
+        self.assertEqual(len(sheets[u'Matières']), 3)
+
+        with self.count_queries() as conn:
+            sheets = controller.export_sessions(start - (end - start), end)
+        self.assertEqual(conn.nb_queries, nb_queries)
+
+    def testExportSessionsNewSubject(self):
+        session = controller.create_session('10/01/2015 14:00', [])
+        student = model.Student.create('qux1', 'quux1')
+        model.Subject.all()
+        # Written by another process, after the catalog was loaded
+        self.db.execute('''INSERT INTO subjects VALUES (10, 'baz', 0, '')''')
+        self.db.execute('''INSERT INTO student_registrations
+                           VALUES (1, ?, ?, 10, 0, '')''',
+                        (session.sid, student.uid))
+        sheets = dict(controller.export_sessions(
+                controller.parse_human_day('10/01/2015'),
+                controller.parse_human_day('11/01/2015')))
+        self.assertEqual(list(sheets[u'Inscriptions élèves'])[1:],
+                         [(session.date, 'quux1', 'baz', 0, '')])
@@ -0,0 +1,114 @@
+# -*- coding: utf8 -*-
+import time
+import email
+import smtpd
+import asyncore
+import threading
+import unittest
+import email.header
+
+import enseigner.emails as emails
+
+class RateLimiterTestCase(unittest.TestCase):
+    def testWait(self):
+        limiter = emails.RateLimiter(100)
+        start = time.time()
+        for i in range(11):
+            limiter.wait()
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        limiter = emails.RateLimiter(0)
+        start = time.time()
+        for i in range(1000):
+            limiter.wait()
+        self.assertLess(time.time() - start, 0.1)
+
+class Server(smtpd.SMTPServer):
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.nb_connections = 0
+        self.messages = []
+
+    def handle_accept(self):
+        self.nb_connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((mailfrom, rcpttos, data))
+
+class SMTPSenderTestCase(unittest.TestCase):
+    def setUp(self):
+        super(SMTPSenderTestCase, self).setUp()
+        self.server = Server()
+        self.thread = threading.Thread(target=asyncore.loop,
+                kwargs={'timeout': 0.01})
+        self.thread.start()
+        self.config = {
+                'server': '127.0.0.1:%d' % self.server.socket.getsockname()[1],
+                'starttls': False,
+                'from': 'foo@example.org',
+                'bcc': 'bar@example.org',
+                'pool_size': 1,
+                'max_messages_per_connection': 2,
+                }
+    def tearDown(self):
+        asyncore.close_all()
+        self.thread.join()
+        super(SMTPSenderTestCase, self).tearDown()
+
+    def testSend(self):
+        with emails.SMTPSender(self.config) as sender:
+            for i in range(3):
+                sender.send('baz%d@example.org' % i, 'qux', u'quux %d' % i)
+        self.assertEqual(len(self.server.messages), 3)
+        (mailfrom, rcpttos, data) = self.server.messages[2]
+        self.assertEqual(mailfrom, 'foo@example.org')
+        self.assertEqual(rcpttos, ['baz2@example.org', 'bar@example.org'])
+        self.assertIn('Subject: qux', data)
+        # Renewed after two messages
+        self.assertEqual(self.server.nb_connections, 2)
+
+    def testFormat(self):
+        sender = emails.SMTPSender(self.config)
+        msg = email.message_from_string(
+                sender.format('baz@example.org', u'Séance', u'é' * 100))
+        self.assertEqual(msg['From'], 'foo@example.org')
+        self.assertEqual(msg['To'], 'baz@example.org')
+        self.assertEqual(msg['Bcc'], 'bar@example.org')
+        self.assertEqual(email.header.decode_header(msg['Subject']),
+                [(u'Séance'.encode('utf8'), 'utf-8')])
+        self.assertEqual(msg.get_content_charset(), 'utf-8')
+        self.assertEqual(msg.get_payload(decode=True).decode('utf8'),
+                u'é' * 100)
+
+    def testReconnect(self):
+        with emails.SMTPSender(self.config) as sender:
+            sender.send('baz@example.org', 'qux', u'quux')
+            sender._connections[0].server.close()
+            sender.send('baz@example.org', 'qux', u'quux')
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(self.server.nb_connections, 2)
+
+    def testStarttlsFailure(self):
+        # The test server does not support STARTTLS
+        self.config['starttls'] = True
+        with emails.SMTPSender(self.config) as sender:
+            for i in range(2):
+                self.assertRaises(emails.smtplib.SMTPException,
+                        sender.send, 'baz@example.org', 'qux', u'quux')
+            self.assertIsNone(sender._connections[0].server)
+        self.assertEqual(self.server.messages, [])
+
+    def testPool(self):
+        self.config['pool_size'] = 2
+        self.config['max_messages_per_connection'] = 100
+        sender = emails.SMTPSender(self.config)
+        threads = [threading.Thread(target=sender.send,
+                                    args=('baz%d@example.org' % i, 'qux', u'quux'))
+                   for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        sender.close()
+        self.assertEqual(len(self.server.messages), 6)
+        self.assertLessEqual(self.server.nb_connections, 2)
@@ -0,0 +1,59 @@
+# -*- coding: utf8 -*-
+import zipfile
+import datetime
+import unittest
+from cStringIO import StringIO
+from xml.dom.minidom import parseString
+
+import enseigner.export as export
+
+class ExportTestCase(unittest.TestCase):
+    def testZipStream(self):
+        archive = export.ZipStream()
+        chunks = ['foo%d' % i * 1000 for i in range(100)]
+        data = ''.join(list(archive.add_stored('foo', 'bar')) +
+                       list(archive.add('baz/qux', iter(chunks))) +
+                       list(archive.close()))
+        zipf = zipfile.ZipFile(StringIO(data))
+        self.assertIs(zipf.testzip(), None)
+        self.assertEqual(zipf.namelist(), ['foo', 'baz/qux'])
+        self.assertEqual(zipf.getinfo('foo').compress_type,
+                         zipfile.ZIP_STORED)
+        self.assertEqual(zipf.read('foo'), 'bar')
+        self.assertEqual(zipf.read('baz/qux'), ''.join(chunks))
+
+    def testOds(self):
+        def rows():
+            yield (u'Nom', u'Matière', None)
+            yield (u'<foo> & bar', 42, datetime.date(2014, 12, 28))
+        data = ''.join(export.to_ods([(u'Tuteurs', rows()),
+                                      (u'Élèves', [])]))
+        zipf = zipfile.ZipFile(StringIO(data))
+        self.assertEqual(zipf.namelist()[0], 'mimetype')
+        self.assertEqual(zipf.read('mimetype'),
+                         'application/vnd.oasis.opendocument.spreadsheet')
+        dom = parseString(zipf.read('content.xml'))
+        tables = dom.getElementsByTagName('table:table')
+        self.assertEqual([x.getAttribute('table:name') for x in tables],
+                         [u'Tuteurs', u'Élèves'])
+        cells = tables[0].getElementsByTagName('table:table-cell')
+        self.assertEqual([x.getAttribute('office:value-type') for x in cells],
+                         ['string', 'string', '', 'string', 'float', 'date'])
+        self.assertEqual(cells[3].firstChild.firstChild.data, u'<foo> & bar')
+        self.assertEqual(cells[4].getAttribute('office:value'), '42')
+
+    def testCsv(self):
+        rows = [(u'é', None, 1)] + [('foo', 'bar, baz', 2)] * 1000
+        chunks = list(export.to_csv(rows, buffer_size=1000))
+        self.assertGreater(len(chunks), 10)
+        lines = ''.join(chunks).splitlines()
+        self.assertEqual(lines[0:2], ['\xc3\xa9,,1', 'foo,"bar, baz",2'])
+        self.assertEqual(len(lines), 1001)
+
+    def testCsvZip(self):
+        data = ''.join(export.to_csv_zip([(u'Élèves', [(u'é', 1)]),
+                                          (u'Tuteurs', [])]))
+        zipf = zipfile.ZipFile(StringIO(data))
+        self.assertEqual(zipf.namelist(), [u'Élèves.csv', u'Tuteurs.csv'])
+        self.assertEqual(zipf.read(u'Élèves.csv'), '\xc3\xa9,1\r\n')
+        self.assertEqual(zipf.read(u'Tuteurs.csv'), '')
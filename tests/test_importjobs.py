@@ -0,0 +1,54 @@
+import os
+import datetime
+from cStringIO import StringIO
+
+from testutils import EnseignerTestCase
+
+import enseigner.model as model
+import enseigner.importjobs as importjobs
+
+CONTACTS = 'First Name,Last Name,E-mail Address\n' + \
+        ''.join('Foo,%d,foo%d@example.org\n' % (i, i) for i in range(3))
+
+class ImportJobTestCase(EnseignerTestCase):
+    def testRun(self):
+        model.Tutor.create('foo1@example.org', 'Foo 1')
+        job = importjobs.spool(StringIO(CONTACTS))
+        self.assertEqual(job.state, 'pending')
+        self.assertTrue(os.path.exists(job.path))
+        importjobs.run(job)
+        self.assertFalse(os.path.exists(job.path))
+        model.ImportJob._instances.clear()
+        self.assertEqual(model.ImportJob.get(job.jid).status(), {
+            'state': 'done',
+            'nb_rows': 3,
+            'nb_imported': 2,
+            'nb_ignored': 1,
+            'error': None,
+            })
+        self.assertEqual(len(model.Tutor.all()), 3)
+
+    def testInterrupted(self):
+        job = model.ImportJob.create('foo.csv')
+        later = job.updated_at + datetime.timedelta(seconds=600)
+        self.assertEqual(job.status()['state'], 'pending')
+        self.assertEqual(job.status(later)['state'], 'interrupted')
+        job.set_state('running')
+        self.assertFalse(job.is_interrupted())
+        self.assertTrue(job.is_interrupted(later))
+        job.set_state('done')
+        self.assertEqual(job.status(later)['state'], 'done')
+
+    def testFailure(self):
+        # The last contact has no email
+        job = importjobs.spool(StringIO(CONTACTS + 'Bar,0\n'))
+        importjobs.run(job, chunk_size=2)
+        self.assertFalse(os.path.exists(job.path))
+        model.ImportJob._instances.clear()
+        job = model.ImportJob.get(job.jid)
+        self.assertEqual(job.state, 'failed')
+        self.assertIn('KeyError', job.error)
+        # The first chunk was imported
+        self.assertEqual((job.nb_rows, job.nb_imported, job.nb_ignored),
+                (2, 2, 0))
+        self.assertEqual(len(model.Tutor.all()), 2)
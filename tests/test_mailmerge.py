@@ -0,0 +1,24 @@
+# -*- coding: utf8 -*-
+import unittest
+
+import enseigner.mailmerge as mailmerge
+
+class TemplateTestCase(unittest.TestCase):
+    def testRender(self):
+        template = mailmerge.Template(u'$$$foo ${bar}baz 100% $foo',
+                ('foo', 'bar', 'qux'))
+        self.assertEqual(template.render({'foo': u'é', 'bar': '%s'}),
+                u'$é %sbaz 100% é')
+
+    def testErrors(self):
+        self.assertRaises(mailmerge.TemplateError,
+                mailmerge.Template, u'$foo $bar', ('foo',))
+        self.assertRaises(mailmerge.TemplateError,
+                mailmerge.Template, u'foo $', ('foo',))
+        self.assertRaises(mailmerge.TemplateError,
+                mailmerge.MailTemplate, u'$foo', u'${foo', ('foo',))
+
+    def testMailTemplate(self):
+        template = mailmerge.MailTemplate(u'$foo', u'bar $foo', ('foo',))
+        self.assertEqual(template.render({'foo': 'baz'}),
+                ('baz', 'bar baz'))
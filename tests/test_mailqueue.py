@@ -0,0 +1,210 @@
+import socket
+import smtplib
+import datetime
+
+from testutils import EnseignerTestCase
+
+import enseigner.model as model
+import enseigner.emails as emails
+import enseigner.mailqueue as mailqueue
+from enseigner.config import config
+
+class WorkerTestCase(EnseignerTestCase):
+    def testDrainSuccess(self):
+        model.Mail.create_many([('foo', 'toto', 'titi bar'),
+                                ('foo2', 'toto', 'titi bar2')])
+        worker = mailqueue.Worker()
+        self.assertEqual(worker.drain(), [])
+        self.assertEqual(set(emails.MockSender.queue), {
+            ('foo', 'toto', 'titi bar'),
+            ('foo2', 'toto', 'titi bar2')
+            })
+        self.assertEqual(model.Mail.count_unsent(), 0)
+        self.assertEqual(worker.drain(), [])
+        self.assertEqual(len(emails.MockSender.queue), 2)
+        status = worker.status()
+        self.assertEqual((status['queued'], status['retrying'],
+                          status['failed'], status['sent']),
+                (0, 0, 0, 2))
+        for row in model.Mail._fetch_many('SELECT * FROM mails'):
+            self.assertEqual(row[5], 1)
+            self.assertTrue(row[8])
+
+    def testDrainMailing(self):
+        mailing = model.Mailing.create('toto', 'titi $nom', ['nom'])
+        model.Mail.create_for_mailing(mailing, [('foo', {'nom': 'bar'}),
+                                                ('foo2', {'nom': 'bar2'})])
+        self.assertEqual(mailqueue.Worker().drain(), [])
+        self.assertEqual(set(emails.MockSender.queue), {
+            ('foo', 'toto', 'titi bar'),
+            ('foo2', 'toto', 'titi bar2')
+            })
+
+    def testDrainError(self):
+        model.Mail.create_many([('foo', 'toto', 'titi bar'),
+                                ('foo2', 'toto', 'titi bar2')])
+        original_send = emails.MockSender.send
+        def fakesend(self, recipient, subject, content):
+            if recipient == 'foo':
+                raise smtplib.SMTPException()
+            original_send(self, recipient, subject, content)
+        emails.MockSender.send = fakesend
+        worker = mailqueue.Worker()
+        try:
+            errors = worker.drain()
+        finally:
+            emails.MockSender.send = original_send
+        self.assertEqual(len(errors), 1, errors)
+        self.assertEqual(errors[0][0].recipient, 'foo')
+        self.assertEqual(emails.MockSender.queue, [
+            ('foo2', 'toto', 'titi bar2')
+            ])
+        self.assertEqual(model.Mail.count_unsent(), 1)
+        mail = errors[0][0]
+        self.assertEqual(mail.attempts, 1)
+        self.assertIn('SMTPException', mail.last_error)
+        delay = mail.next_attempt - datetime.datetime.now()
+        self.assertTrue(50 < delay.seconds <= 60, delay)
+        # Failed mails are not tried again until their next attempt
+        self.assertEqual(worker.drain(), [])
+        self.assertEqual(len(emails.MockSender.queue), 1)
+        status = worker.status()
+        self.assertEqual((status['queued'], status['retrying'],
+                          status['failed'], status['sent']),
+                (0, 1, 0, 1))
+        self.assertTrue(55 <= worker._timeout() <= 60, worker._timeout())
+        self.assertEqual(worker.drain(mail.next_attempt), [])
+        self.assertEqual(len(emails.MockSender.queue), 2)
+        self.assertEqual(model.Mail.count_unsent(), 0)
+
+    def testGiveUp(self):
+        mail = model.Mail.create('foo', 'toto', 'titi bar')
+        def fakesend(self, recipient, subject, content):
+            raise socket.error()
+        original_send = emails.MockSender.send
+        emails.MockSender.send = fakesend
+        worker = mailqueue.Worker()
+        worker.max_attempts = 3
+        try:
+            self.assertEqual(len(worker.drain()), 1)
+            self.assertEqual(len(worker.drain(mail.next_attempt)), 1)
+            delay = mail.next_attempt - datetime.datetime.now()
+            self.assertTrue(110 < delay.seconds <= 120, delay)
+            self.assertEqual(len(worker.drain(mail.next_attempt)), 1)
+            self.assertIs(mail.next_attempt, None)
+            self.assertEqual(worker.drain(datetime.datetime.max), [])
+        finally:
+            emails.MockSender.send = original_send
+        self.assertEqual(mail.attempts, 3)
+        self.assertEqual(worker.status()['failed'], 1)
+        self.assertEqual(worker._timeout(), worker.poll_interval)
+
+    def testDrainMany(self):
+        model.Mail.create_many(('foo%d' % i, 'toto', 'titi') for i in range(250))
+        worker = mailqueue.Worker(nb_threads=4)
+        worker.ack_max_delay = 60
+        with self.count_queries() as conn:
+            self.assertEqual(worker.drain(), [])
+        # One per 100 mails fetched, two per 100 mails claimed, then one
+        # per 100 mails sent
+        self.assertEqual(conn.nb_queries, 3 + 2 * 3 + 3)
+        self.assertEqual({x[0] for x in emails.MockSender.queue},
+                {'foo%d' % i for i in range(250)})
+        self.assertEqual(model.Mail.count_unsent(), 0)
+
+    def testClaimed(self):
+        mails = model.Mail.create_many(('foo%d' % i, 'toto', 'titi')
+                                       for i in range(4))
+        # Claimed or sent by other workers since they were fetched
+        model.Mail.set_sent_many(mails[:1])
+        self.db.execute('UPDATE mails SET mail_attempts=1 WHERE mail_id=?',
+                        (mails[3].mid,))
+        until = datetime.datetime.now() + datetime.timedelta(hours=1)
+        self.assertEqual(model.Mail.claim_many(mails[:2], until), mails[1:2])
+        until += datetime.timedelta(seconds=1)
+        self.assertEqual(model.Mail.claim_many(mails, until), mails[2:3])
+        self.assertEqual(mailqueue.Worker().drain(), [])
+        self.assertEqual(emails.MockSender.queue, [])
+
+    def testConcurrentDrains(self):
+        model.Mail.create_many(('foo%d' % i, 'toto', 'titi') for i in range(5))
+        worker = mailqueue.Worker(nb_threads=1)
+        worker.claim_batch_size = 2
+        other = mailqueue.Worker(nb_threads=1)
+        render = model.Mail.render
+        def render_after_other_drain(mail):
+            # The other worker drains the queue after this one fetched
+            # its first mails
+            model.Mail.render = render
+            self.assertEqual(other.drain(), [])
+            return render(mail)
+        model.Mail.render = render_after_other_drain
+        try:
+            self.assertEqual(worker.drain(), [])
+        finally:
+            model.Mail.render = render
+        self.assertEqual(sorted(x[0] for x in emails.MockSender.queue),
+                         ['foo%d' % i for i in range(5)])
+        self.assertEqual(worker.nb_sent + other.nb_sent, 5)
+
+    def testDrainInterrupted(self):
+        mails = model.Mail.create_many(('foo%d' % i, 'toto', 'titi')
+                                       for i in range(4))
+        worker = mailqueue.Worker(nb_threads=1)
+        render = model.Mail.render
+        def render_or_fail(mail):
+            if mail is mails[2]:
+                raise ValueError()
+            return render(mail)
+        model.Mail.render = render_or_fail
+        try:
+            self.assertRaises(ValueError, worker.drain)
+        finally:
+            model.Mail.render = render
+        self.assertEqual(sorted(x[0] for x in emails.MockSender.queue),
+                         ['foo0', 'foo1'])
+        model.Mail._instances.clear()
+        self.assertEqual([model.Mail.get(x.mid).sent for x in mails],
+                         [True, True, False, False])
+
+class StartTestCase(EnseignerTestCase):
+    def setUp(self):
+        super(StartTestCase, self).setUp()
+        self.worker = mailqueue.worker
+        self.email_config = config['email']
+        config['email'] = dict(config['email'])
+        self.started = []
+        class Worker(mailqueue.Worker):
+            def start(worker):
+                self.started.append(worker)
+        mailqueue.worker = Worker()
+    def tearDown(self):
+        mailqueue.worker = self.worker
+        config['email'] = self.email_config
+        super(StartTestCase, self).tearDown()
+
+    def testStart(self):
+        config['email']['worker'] = 'thread'
+        self.assertTrue(mailqueue.start())
+        self.assertEqual(self.started, [mailqueue.worker])
+
+    def testSeparateProcess(self):
+        config['email']['worker'] = 'process'
+        self.assertFalse(mailqueue.start())
+        mailqueue.notify()
+        self.assertEqual(self.started, [])
+
+class SentBatchTestCase(EnseignerTestCase):
+    def testFlush(self):
+        mails = model.Mail.create_many(('foo%d' % i, 'toto', 'titi') for i in range(5))
+        batch = mailqueue.SentBatch(3, 60)
+        for mail in mails[0:2]:
+            batch.add(mail)
+        self.assertEqual(model.Mail.count_unsent(), 5)
+        batch.add(mails[2])
+        self.assertEqual(model.Mail.count_unsent(), 2)
+        self.assertTrue(all(x.sent for x in mails[0:3]))
+        batch.add(mails[3])
+        batch.max_delay = 0
+        batch.add(mails[4])
+        self.assertEqual(model.Mail.count_unsent(), 0)
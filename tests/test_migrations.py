@@ -0,0 +1,54 @@
+from testutils import EnseignerTestCase
+
+import enseigner.model as model
+import enseigner.migrations as migrations
+
+class MigrationsTestCase(EnseignerTestCase):
+    def columns(self, table):
+        return [x[1] for x in self.db.execute('PRAGMA table_info(%s)' % table)]
+
+    def testUpToDate(self):
+        # setUp created the tables of the models, then upgraded them.
+        self.assertEqual(migrations.current_version(self.db),
+                         len(migrations.migrations))
+        self.assertEqual(migrations.upgrade(self.db), [])
+        plan = self.db.execute('''EXPLAIN QUERY PLAN SELECT * FROM mails
+                                  WHERE mail_id>? AND (mail_sent=0)
+                                  ORDER BY mail_id LIMIT ?''',
+                               (0, 100)).fetchall()
+        self.assertIn('mails_sent', plan[0][3])
+
+    def testUpgradeOldDatabase(self):
+        self.db = model.sqlite3.connect(':memory:')
+        model.get_conn = lambda: self.db
+        for table in model.tables:
+            if table._table not in ('mails', 'mailings', 'import_jobs'):
+                self.db.execute(table._create_table)
+        self.db.execute('''CREATE TABLE mails (
+            mail_id INTEGER PRIMARY KEY,
+            mail_recipient TEXT,
+            mail_subject TEXT,
+            mail_content TEXT,
+            mail_sent BOOLEAN
+            )''')
+        self.db.execute('''INSERT INTO mails VALUES
+                           (1, 'foo@example.org', 'foo', 'bar', 0)''')
+        self.assertEqual(migrations.current_version(), 0)
+
+        self.assertEqual(migrations.upgrade(),
+                         [x.__name__ for x in migrations.migrations])
+        db = model.sqlite3.connect(':memory:')
+        db.execute(model.Mail._create_table)
+        self.assertEqual(self.columns('mails'),
+                         [x[1] for x in db.execute('PRAGMA table_info(mails)')])
+        mail = model.Mail.get(1)
+        self.assertEqual((mail.subject, mail.attempts, mail.sent),
+                         ('foo', 0, False))
+        model.ImportJob.create('foo.csv')
+        self.assertEqual(migrations.upgrade(), [])
+
+    def testResume(self):
+        # A migration interrupted after some of its changes is applied again
+        self.db.execute('DELETE FROM schema_migrations WHERE migration_version>1')
+        self.assertEqual(migrations.upgrade(self.db),
+                         [x.__name__ for x in migrations.migrations[1:]])
@@ -1,6 +1,14 @@
+# -*- coding: utf8 -*-
+import os
+import shutil
+import tempfile
+import threading
+
 from testutils import EnseignerTestCase
 
 import enseigner.model as model
+import enseigner.mailmerge as mailmerge
+from enseigner.config import config
 
 class ModelTestCase(EnseignerTestCase):
     def testSingleton(self):
@@ -16,16 +24,58 @@ class ModelTestCase(EnseignerTestCase):
 
     def testRepr(self):
         t1 = model.Tutor.create('foo', '', 'bar')
+        self.assertTrue(t1.password_hash.startswith('pbkdf2_sha256$'))
         self.assertEqual(repr(t1),
                 "<enseigner.model.Tutor(uid=1, email='foo', name='', "
                 "password_hash='%s', phone_number=None, is_admin=False, "
-                "is_active=True, comment=None)>" %
-                model.password_hash(t1.uid, 'bar'))
+                "is_active=True, comment=None)>" % t1.password_hash)
 
     def testGetattr(self):
         t1 = model.Tutor.create('foo', '', 'bar')
         self.assertFalse(hasattr(t1, 'fojgjoj'))
 
+    def testIdentityMap(self):
+        class Foo(object):
+            pass
+        foos = [Foo() for i in range(4)]
+        im = model.IdentityMap(2)
+        for (i, foo) in enumerate(foos):
+            im[i] = foo
+        self.assertIs(im.lookup(0), foos[0])
+        self.assertEqual((im.hits, im.misses), (1, 0))
+        im.invalidate(1)
+        self.assertIs(im.lookup(1), None)
+        self.assertEqual((im.hits, im.misses), (1, 1))
+        self.assertIs(im.get(1), foos[1])
+        del foos[:]
+        # Only the two most recently used ones are still referenced
+        self.assertEqual(set(im._weak.keys()), {3, 0})
+        self.assertIs(im.lookup(2), None)
+
+    def testCache(self):
+        t1 = model.Tutor.create('foo', 'bar')
+        t1_id = t1.uid
+        del t1
+        with self.count_queries() as conn:
+            self.assertEqual(model.Tutor.get(t1_id).name, 'bar')
+        self.assertEqual(conn.nb_queries, 0)
+
+        s1 = model.Session.create('foo', 'bar')
+        with self.count_queries() as conn:
+            s1.set_emailed_tutors()
+            self.assertIs(model.Session.get(s1.sid), s1)
+        self.assertEqual(conn.nb_queries, 2)
+        with self.count_queries() as conn:
+            self.assertIs(model.Session.get(s1.sid), s1)
+        self.assertEqual(conn.nb_queries, 0)
+
+    def testRefresh(self):
+        s1 = model.Session.create('foo', 'bar')
+        self.db.execute('UPDATE sessions SET session_is_open=0')
+        self.assertIs(s1.is_open, True)
+        self.assertEqual(model.Session.all(), {s1})
+        self.assertIs(s1.is_open, False)
+
 class TutorTestCase(EnseignerTestCase):
     def testGetTutors(self):
         t1 = model.Tutor.create('foo', '', 'bar', False)
@@ -39,6 +89,61 @@ class TutorTestCase(EnseignerTestCase):
         self.assertIs(None, model.Tutor.check_password('foo', 'bar2'))
         self.assertIs(t2, model.Tutor.check_password('foo2', 'bar2'))
         self.assertIs(None, model.Tutor.check_password('foo2', 'bar'))
+        with self.count_queries() as conn:
+            self.assertIs(t1, model.Tutor.check_password('foo', 'bar'))
+            self.assertIs(None, model.Tutor.check_password('foo3', 'bar'))
+        self.assertEqual(conn.nb_queries, 2)
+        self.assertIs(None, model.Tutor.create('foo3', '').password_hash)
+        self.assertIs(None, model.Tutor.check_password('foo3', ''))
+        t4 = model.Tutor.create('foo4', '', u'bé')
+        self.assertIs(t4, model.Tutor.check_password('foo4', u'bé'))
+
+    def testCheckPasswordCost(self):
+        # One PBKDF2 hash per login attempt, whatever the email is
+        model.Tutor.create('foo', '', 'bar')
+        t2 = model.Tutor.create('foo2', '')
+        model.Tutor.create('foo3', '')
+        self.db.execute('''UPDATE tutors SET tutor_password_hash=?
+                           WHERE tutor_email='foo3' ''',
+                        (model.legacy_password_hash(t2.uid + 1, 'bar'),))
+        model.Tutor._instances.clear()
+        iterations = []
+        pbkdf2_hmac = model.hashlib.pbkdf2_hmac
+        def counting_pbkdf2_hmac(name, password, salt, rounds):
+            iterations.append(rounds)
+            return pbkdf2_hmac(name, password, salt, rounds)
+        model.hashlib.pbkdf2_hmac = counting_pbkdf2_hmac
+        try:
+            for email in ('foo', 'foo2', 'foo3', 'unknown'):
+                del iterations[:]
+                self.assertIs(None, model.Tutor.check_password(email, 'baz'))
+                self.assertEqual(iterations,
+                                 [config['password_iterations']], email)
+        finally:
+            model.hashlib.pbkdf2_hmac = pbkdf2_hmac
+
+    def testPasswordRehash(self):
+        t1 = model.Tutor.create('foo', '')
+        legacy = model.legacy_password_hash(t1.uid, 'bar')
+        self.db.execute('UPDATE tutors SET tutor_password_hash=?',
+                        (legacy,))
+        model.Tutor._instances.clear()
+        self.assertIs(None, model.Tutor.check_password('foo', 'baz'))
+        self.assertEqual(model.Tutor.get(t1.uid).password_hash, legacy)
+        t1 = model.Tutor.check_password('foo', 'bar')
+        self.assertTrue(t1.password_hash.startswith('pbkdf2_sha256$'))
+        model.Tutor._instances.clear()
+        self.assertIs(model.Tutor.check_password('foo', 'bar').uid, t1.uid)
+        # More iterations
+        old_hash = t1.password_hash
+        config['password_iterations'] += 1
+        try:
+            t1 = model.Tutor.check_password('foo', 'bar')
+        finally:
+            config['password_iterations'] -= 1
+        self.assertNotEqual(t1.password_hash, old_hash)
+        self.assertEqual(model.Tutor._fetch_many(
+            'SELECT tutor_password_hash FROM tutors')[0][0], t1.password_hash)
 
 class StudentTestCase(EnseignerTestCase):
     def testGetStudents(self):
@@ -147,6 +252,37 @@ class SessionTestCase(EnseignerTestCase):
         self.assertTrue(s1.emailed_tutors)
         self.assertTrue(s1.emailed_students)
 
+    def testConverters(self):
+        date = model.datetime.datetime(2014, 12, 27, 14, 0)
+        s1 = model.Session.create(date, 'bar')
+        self.assertIs(s1.date, date)
+        del model.Session._instances[s1.sid]
+        s1b = model.Session.get(s1.sid)
+        self.assertEqual(s1b._attributes['date'], '2014-12-27 14:00:00')
+        self.assertEqual(s1b.date, date)
+        self.assertIs(s1b.date, s1b.date)
+        self.assertIs(s1b.emailed_tutors, False)
+        self.assertIs(s1b.is_open, True)
+
+    def testAllWithCounts(self):
+        s1 = model.Session.create('2014-12-27 14:00:00', 'bar')
+        s2 = model.Session.create('2015-01-03 14:00:00', 'bar2')
+        s3 = model.Session.create('2015-01-10 14:00:00', 'bar3')
+        t1 = model.Tutor.create('foo', '', 'bar', False)
+        t2 = model.Tutor.create('foo2', '', 'bar', False)
+        st1 = model.Student.create('foo', 'bar', False, False, '')
+        sub1 = model.Subject.create('foo', False)
+        model.TutorRegistration.create(s1, t1, 3, None)
+        model.TutorRegistration.create(s1, t2, 3, None)
+        model.TutorRegistration.create(s2, t2, 3, None)
+        model.StudentRegistration.create(s1, st1, sub1, 1, None)
+        with self.count_queries() as conn:
+            r = model.Session.all_with_counts()
+        self.assertEqual(conn.nb_queries, 1)
+        self.assertEqual(r, [(s3, 0, 0), (s2, 1, 0), (s1, 2, 1)])
+        self.assertEqual([(x.nb_tutors, x.nb_students) for (x, _, _) in r],
+                [(0, 0), (1, 0), (2, 1)])
+
 class SregTestCase(EnseignerTestCase):
     def testGetFindAll(self):
         s1 = model.Session.create('foo', 'bar')
@@ -211,6 +347,44 @@ class MiscTestCase(EnseignerTestCase):
         self.assertEqual(set(model.Subject.all_permanent()), {sub1, sub3})
         self.assertEqual(set(model.Subject.all()), {sub1, sub2, sub3})
 
+    def testSubjectCatalog(self):
+        s1 = model.Session.create('foo', 'bar')
+        sub1 = model.Subject.create('foo', True)
+        sub2 = model.Subject.create('bar', False)
+        model.SessionSubject.create_for_session(s1, [sub1])
+        self.assertEqual(model.Subject.all(), {sub1, sub2})
+        with self.count_queries() as conn:
+            self.assertIs(model.Subject.get(sub1.sid), sub1)
+            self.assertEqual(model.Subject.all_permanent(), {sub2})
+            self.assertEqual(model.SessionSubject.all_subjects_for_session(s1),
+                    {sub1, sub2})
+        self.assertEqual(conn.nb_queries, 0)
+
+        # Rows written by another process
+        self.db.execute("""INSERT INTO subjects VALUES (10, 'baz', 1, '')""")
+        self.db.execute("""INSERT INTO session_subjects
+                           VALUES (10, 10, 10, 1)""")
+        self.assertEqual(model.Subject.get(10).name, 'baz')
+        self.assertEqual(model.Subject.all_permanent(), {sub2})
+        self.assertEqual(model.SessionSubject.all_subjects_for_session(s1),
+                {sub1, sub2})
+        self.assertRaises(model.NotFound, model.Subject.get, 11)
+
+        # Sessions without subjects of their own
+        s2 = model.Session.create('foo2', 'bar2')
+        self.db.execute('''INSERT INTO sessions (session_id) VALUES (20)''')
+        for session in (s2, 20):
+            self.assertEqual(
+                    model.SessionSubject.all_subjects_for_session(session),
+                    {sub2})
+            with self.count_queries() as conn:
+                model.SessionSubject.all_subjects_for_session(session)
+            self.assertEqual(conn.nb_queries, 0)
+        with self.count_queries() as conn:
+            for i in range(3):
+                model.subject_catalog.for_session(21)
+        self.assertEqual(conn.nb_queries, 3)
+
     def testSessionSubject(self):
         s1 = model.Session.create('foo', 'bar')
         s2 = model.Session.create('foo2', 'bar2')
@@ -231,3 +405,163 @@ class MiscTestCase(EnseignerTestCase):
                 {sub2, sub3, sub4, sub5})
         self.assertEqual(model.SessionSubject.all_subjects_for_session(s3),
                 {sub2, sub3, sub4, sub5})
+
+class TransactionTestCase(EnseignerTestCase):
+    def testCommit(self):
+        with model.transaction():
+            t1 = model.Tutor.create('foo', '', 'bar', False)
+            with model.transaction():
+                s1 = model.Session.create('foo', 'bar')
+            self.assertTrue(model.in_transaction())
+        self.assertFalse(model.in_transaction())
+        self.assertEqual(set(model.Tutor.all()), {t1})
+        self.assertEqual(set(model.Session.all()), {s1})
+
+    def testRollback(self):
+        t1 = model.Tutor.create('foo', '', 'bar', False)
+        def f():
+            with model.transaction():
+                model.Tutor.create('foo2', '', 'bar', False)
+                model.Tutor.create('foo', '', 'bar', False)
+        self.assertRaises(model.Duplicate, f)
+        self.assertFalse(model.in_transaction())
+        self.assertEqual({x.email for x in model.Tutor.all()}, {'foo'})
+        t2 = model.Tutor.create('foo2', '', 'bar', False)
+        self.assertEqual({x.email for x in model.Tutor.all()}, {'foo', 'foo2'})
+
+    def testSnapshot(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'db.sqlite3')
+            self.db = model.sqlite3.connect(path)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute(model.Subject._create_table)
+            other = model.sqlite3.connect(path)
+            with model.transaction(snapshot=True):
+                self.assertEqual(model.Subject.all(cached=False), set())
+                other.execute('''INSERT INTO subjects
+                                 VALUES (1, 'foo', 0, '')''')
+                other.commit()
+                self.assertEqual(model.Subject.all(cached=False), set())
+            self.assertEqual([x.name for x in model.Subject.all(cached=False)],
+                             ['foo'])
+            other.close()
+            self.db.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+class MailTestCase(EnseignerTestCase):
+    def testCreateMany(self):
+        m1 = model.Mail.create('foo', 'bar', 'baz')
+        rows = (('foo%d' % i, 'bar', 'baz%d' % i) for i in range(1200))
+        with self.count_queries() as conn:
+            mails = model.Mail.create_many(rows)
+        self.assertEqual(conn.nb_queries, 6)
+        self.assertEqual(len(mails), 1200)
+        for (i, mail) in enumerate(mails):
+            self.assertEqual(mail.mid, m1.mid + i + 1)
+            self.assertEqual(mail.recipient, 'foo%d' % i)
+        del model.Mail._instances[mails[42].mid]
+        self.assertEqual(model.Mail.get(mails[42].mid).content, 'baz42')
+        self.assertEqual(model.Mail.create_many([('foo', 'bar', 'baz')], False),
+                1)
+        self.assertEqual(len(model.Mail.all_unsent()), 1202)
+
+    def testCreateManyReusedId(self):
+        mail = model.Mail.create('foo', 'bar', 'baz')
+        self.db.execute('DELETE FROM mails')
+        # The deleted row's id is reused; its instance is updated
+        (new, other) = model.Mail.create_many([('qux', 'bar', 'baz')] * 2)
+        self.assertIs(new, mail)
+        self.assertEqual(new.recipient, 'qux')
+        self.assertIs(model.Mail.get(other.mid), other)
+
+    def testIterUnsent(self):
+        mails = model.Mail.create_many(('foo%d' % i, 'bar', 'baz')
+                                       for i in range(25))
+        mails[3].set_sent()
+        mails[7].set_failed('error', None)
+        with self.count_queries() as conn:
+            it = model.Mail.iter_unsent(chunk_size=10)
+            self.assertIs(next(it), mails[0])
+            self.assertEqual(conn.nb_queries, 1)
+            unsent = [mails[0]] + list(it)
+        self.assertEqual(conn.nb_queries, 3)
+        self.assertEqual(unsent, [x for (i, x) in enumerate(mails) if i != 3])
+        due = list(model.Mail.iter_due(1, chunk_size=8))
+        self.assertEqual(due, [x for (i, x) in enumerate(mails)
+                               if i not in (3, 7)])
+        self.assertEqual(model.Mail.count_due(1), 23)
+        # A mail sent while iterating does not stop the iteration
+        it = model.Mail.iter_unsent(chunk_size=2)
+        for mail in it:
+            mail.set_sent()
+        self.assertEqual(model.Mail.count_unsent(), 0)
+
+    def testMailing(self):
+        self.assertRaises(mailmerge.TemplateError, model.Mailing.create,
+                u'$foo', u'$bar', ['foo'])
+        mailing = model.Mailing.create(u'$foo', u'bar $foo $baz',
+                                       ['foo', 'baz'])
+        mails = model.Mail.create_for_mailing(mailing, [
+            ('qux', {'foo': u'é', 'baz': 1}),
+            ('quux', {'foo': u'%s', 'baz': 2, 'corge': 3}),
+            ])
+        mail = model.Mail.create('qux', 'foo', 'bar')
+        self.assertEqual(mails[0].render(), (u'é', u'bar é 1'))
+        self.assertEqual(mail.render(), ('foo', 'bar'))
+        model.Mail._instances.clear()
+        model.Mailing._instances.clear()
+        mail = model.Mail.get(mails[1].mid)
+        self.assertIs(mail.subject, None)
+        self.assertEqual(mail.variables, [u'%s', 2])
+        self.assertEqual(mail.render(), (u'%s', u'bar %s 2'))
+        self.assertEqual(model.Mailing.get(mailing.mgid).variables,
+                         ['foo', 'baz'])
+
+class ConnectionPoolTestCase(EnseignerTestCase):
+    def setUp(self):
+        super(ConnectionPoolTestCase, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.pool = model.ConnectionPool(
+                os.path.join(self.tmpdir, 'db.sqlite3'), 1,
+                ['journal_mode=WAL'])
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.tmpdir)
+        super(ConnectionPoolTestCase, self).tearDown()
+
+    def testPerThread(self):
+        conn = self.pool.get()
+        self.assertIs(self.pool.get(), conn)
+        self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0],
+                'wal')
+        other = []
+        t = threading.Thread(target=lambda: other.append(self.pool.get()))
+        t.start()
+        t.join()
+        self.assertIsNot(other[0], conn)
+
+    def testRelease(self):
+        conn = self.pool.get()
+        conn.execute('CREATE TABLE foo (bar INTEGER)')
+        conn.execute('INSERT INTO foo VALUES (1)')
+        self.pool.release()
+        self.assertIs(self.pool.get(), conn)
+        self.assertEqual(conn.execute('SELECT * FROM foo').fetchall(), [])
+
+    def testMaxSize(self):
+        conns = []
+        def f():
+            conns.append(self.pool.get())
+            self.pool.release()
+        t = threading.Thread(target=f)
+        t.start()
+        t.join()
+        self.assertIs(self.pool.get(), conns[0])
+        t = threading.Thread(target=f)
+        t.start()
+        t.join()
+        self.assertIsNot(conns[1], conns[0])
+        self.pool.release()
+        self.assertEqual(self.pool._idle, [conns[1]])
@@ -0,0 +1,57 @@
+import unittest
+
+from testutils import EnseignerTestCase
+
+import enseigner.ratelimit as ratelimit
+
+class SlidingWindowMixin(object):
+    def testHit(self):
+        window = ratelimit.SlidingWindow(3, 10, self.store)
+        for i in range(3):
+            self.assertTrue(window.hit('foo', 1000 + i))
+        self.assertFalse(window.hit('foo', 1005))
+        self.assertTrue(window.hit('bar', 1005))
+        # Half of the previous bucket is still in the window
+        self.assertEqual(window.count('foo', 1015), 1.5)
+        self.assertTrue(window.hit('foo', 1015))
+        self.assertTrue(window.hit('foo', 1015))
+        self.assertFalse(window.hit('foo', 1015))
+        self.assertAlmostEqual(window.count('foo', 1021), 1.8)
+        self.assertEqual(window.count('foo', 1040), 0)
+        window.reset('bar')
+        self.assertEqual(window.count('bar', 1006), 0)
+
+    def testForget(self):
+        window = ratelimit.SlidingWindow(3, 10, self.store)
+        window.hit('foo', 1000)
+        window.hit('foo', 1010)
+        window.hit('foo', 1020)
+        # The first bucket is dropped by the third hit
+        self.assertEqual(self.store.get('foo', 1029), {101: 1, 102: 1})
+        self.assertEqual(self.store.get('foo', 1040), {})
+        # Purged, one purge_interval after the first hit
+        window.hit('bar', 1060)
+        self.assertEqual(self.store.get('foo', 0), {})
+        self.assertEqual(self.store.get('bar', 0), {106: 1})
+
+class MemoryStoreTestCase(unittest.TestCase, SlidingWindowMixin):
+    def setUp(self):
+        super(MemoryStoreTestCase, self).setUp()
+        self.store = ratelimit.MemoryStore()
+
+class SQLiteStoreTestCase(EnseignerTestCase, SlidingWindowMixin):
+    def setUp(self):
+        super(SQLiteStoreTestCase, self).setUp()
+        self.store = ratelimit.SQLiteStore()
+
+class LoginThrottleTestCase(unittest.TestCase):
+    def testAllow(self):
+        throttle = ratelimit.LoginThrottle({'per_ip': [3, 60],
+                                            'per_email': [2, 60]})
+        self.assertTrue(throttle.allow('1.2.3.4', 'foo', 1000))
+        self.assertTrue(throttle.allow('1.2.3.4', 'Foo', 1000))
+        self.assertFalse(throttle.allow('1.2.3.4', 'foo', 1000))
+        self.assertFalse(throttle.allow('1.2.3.4', 'bar', 1000))
+        self.assertTrue(throttle.allow('1.2.3.5', 'bar', 1000))
+        throttle.succeeded('FOO')
+        self.assertTrue(throttle.allow('1.2.3.5', 'foo', 1000))
@@ -0,0 +1,44 @@
+import unittest
+
+import enseigner.signing as signing
+
+SECRET = 'a secret which is long enough'
+
+class LinkSignerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.signer = signing.LinkSigner(SECRET)
+
+    def testVerify(self):
+        token = self.signer.sign(1, 'tutor', 2)
+        self.assertEqual(len(token), 32)
+        self.assertTrue(self.signer.verify(token, 1, 'tutor', 2))
+        self.assertTrue(self.signer.verify(unicode(token), 1, 'tutor', 2))
+        self.assertFalse(self.signer.verify(token, 1, 'student', 2))
+        self.assertFalse(self.signer.verify(token, 1, 'tutor', 3))
+        self.assertFalse(self.signer.verify(token, 2, 'tutor', 2))
+        self.assertFalse(self.signer.verify(token[:-1], 1, 'tutor', 2))
+        self.assertFalse(self.signer.verify(u'\xe9', 1, 'tutor', 2))
+        other = signing.LinkSigner('another secret, also long enough')
+        self.assertFalse(other.verify(token, 1, 'tutor', 2))
+
+    def testExpiry(self):
+        token = self.signer.sign(1, 'tutor', 2, expires=1000)
+        self.assertTrue(self.signer.verify(token, 1, 'tutor', 2, now=999))
+        self.assertFalse(self.signer.verify(token, 1, 'tutor', 2, now=1001))
+        # The expiry date cannot be changed
+        (expires, mac) = token.split('-')
+        self.assertFalse(self.signer.verify('%x-%s' % (2000, mac),
+                                            1, 'tutor', 2, now=999))
+        self.assertFalse(self.signer.verify('zz-' + mac, 1, 'tutor', 2))
+
+    def testLegacy(self):
+        token = signing.legacy_signature(SECRET, 1, 'tutor', 2)
+        self.assertTrue(self.signer.verify(token, 1, 'tutor', 2))
+        self.assertFalse(self.signer.verify(token, 1, 'tutor', 3))
+        signer = signing.LinkSigner(SECRET, accept_legacy=False)
+        self.assertFalse(signer.verify(token, 1, 'tutor', 2))
+
+    def testSignMany(self):
+        tokens = self.signer.sign_many(1, 'tutor', [2, 3, 4], expires=1000)
+        self.assertEqual(tokens,
+                {x: self.signer.sign(1, 'tutor', x, 1000) for x in (2, 3, 4)})
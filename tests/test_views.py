@@ -0,0 +1,106 @@
+from testutils import EnseignerTestCase
+
+import enseigner.model as model
+import enseigner.views as views
+import enseigner.ratelimit as ratelimit
+from enseigner.views import app
+from enseigner.config import config
+
+# Do not start the mail worker
+app.testing = True
+
+class AuthTestCase(EnseignerTestCase):
+    def setUp(self):
+        super(AuthTestCase, self).setUp()
+        self.client = app.test_client()
+        self.admin = model.Tutor.create('foo', 'bar', 'baz', is_admin=True)
+        self.tutor = model.Tutor.create('foo2', 'bar2', 'baz')
+
+    def login(self, tutor):
+        with self.client.session_transaction() as session:
+            session['tutor_id'] = tutor.uid
+
+    def get(self):
+        model.Tutor._instances.clear()
+        with self.count_queries() as conn:
+            r = self.client.get('/gestion_contacts/')
+        return (r, conn.nb_queries)
+
+    def testNotLoggedIn(self):
+        (r, nb_queries) = self.get()
+        self.assertEqual(r.status_code, 302)
+        self.assertIn('/connexion/', r.location)
+        self.assertEqual(nb_queries, 0)
+
+    def testCachedAdmin(self):
+        self.login(self.admin)
+        (r, nb_queries) = self.get()
+        self.assertEqual(r.status_code, 302)
+        self.assertIn('/gestion_contacts/tuteurs/', r.location)
+        self.assertEqual(nb_queries, 1)
+        (r, nb_queries) = self.get()
+        self.assertIn('/gestion_contacts/tuteurs/', r.location)
+        self.assertEqual(nb_queries, 0)
+        # Revoked
+        config['auth_version'] = 1
+        self.assertEqual(self.get()[1], 1)
+        self.assertEqual(self.get()[1], 0)
+        # Expired
+        config['auth_cache_ttl'] = 0
+        self.assertEqual(self.get()[1], 1)
+
+    def testDemoted(self):
+        self.login(self.admin)
+        self.assertEqual(self.client.get('/gestion_contacts/').status_code,
+                         302)
+        self.db.execute('UPDATE tutors SET tutor_is_admin=0')
+        # The instance of the tutor is still in the identity map
+        self.assertTrue(model.Tutor.get(self.admin.uid).is_admin)
+        self.assertEqual(self.client.get('/gestion_contacts/').status_code,
+                         302)
+        config['auth_cache_ttl'] = 0
+        self.assertEqual(self.client.get('/gestion_contacts/').status_code,
+                         200)
+        self.assertFalse(model.Tutor.get(self.admin.uid).is_admin)
+
+    def testNotAdmin(self):
+        self.login(self.tutor)
+        (r, nb_queries) = self.get()
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('responsables du soutien', r.data.decode('utf8'))
+        self.assertEqual(self.get()[1], 0)
+
+    def testOtherTutor(self):
+        self.login(self.tutor)
+        self.get()
+        # The cached status is for another tutor
+        self.login(self.admin)
+        (r, nb_queries) = self.get()
+        self.assertEqual(nb_queries, 1)
+        self.assertEqual(r.status_code, 302)
+
+class ConnexionTestCase(EnseignerTestCase):
+    def setUp(self):
+        super(ConnexionTestCase, self).setUp()
+        self.client = app.test_client()
+        model.Tutor.create('foo', 'bar', 'baz', is_admin=True)
+        self.login_throttle = views.login_throttle
+        views.login_throttle = ratelimit.LoginThrottle({'per_email': [3, 60]})
+    def tearDown(self):
+        views.login_throttle = self.login_throttle
+        super(ConnexionTestCase, self).tearDown()
+
+    def login(self, password):
+        with self.client.session_transaction() as session:
+            session['_csrf_token'] = 'token'
+        with self.count_queries() as conn:
+            r = self.client.post('/connexion/', data={'email': 'foo',
+                'password': password, '_csrf_token': 'token'})
+        return (r.status_code, conn.nb_queries)
+
+    def testThrottle(self):
+        self.assertEqual(self.login('qux'), (200, 1))
+        self.assertEqual(self.login('baz'), (302, 1))
+        for i in range(3):
+            self.assertEqual(self.login('qux'), (200, 1))
+        self.assertEqual(self.login('baz'), (429, 0))
@@ -1,7 +1,45 @@
 import unittest
+import contextlib
 
 import enseigner.model as model
 import enseigner.emails as emails
+import enseigner.migrations as migrations
+from enseigner.config import config
+
+class CountingCursor(object):
+    def __init__(self, conn, cursor):
+        self._conn = conn
+        self._cursor = cursor
+    def execute(self, *args):
+        self._conn.nb_queries += 1
+        return self._cursor.execute(*args)
+    def executemany(self, *args):
+        self._conn.nb_queries += 1
+        return self._cursor.executemany(*args)
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+    def __iter__(self):
+        return iter(self._cursor)
+
+class CountingConnection(object):
+    """Wraps a connection to count the queries sent through it."""
+    def __init__(self, conn):
+        self._conn = conn
+        self.nb_queries = 0
+    def cursor(self):
+        return CountingCursor(self, self._conn.cursor())
+    def execute(self, *args):
+        self.nb_queries += 1
+        return self._conn.execute(*args)
+    def executemany(self, *args):
+        self.nb_queries += 1
+        return self._conn.executemany(*args)
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+    def __enter__(self):
+        return self._conn.__enter__()
+    def __exit__(self, *args):
+        return self._conn.__exit__(*args)
 
 class EnseignerTestCase(unittest.TestCase):
     def setUp(self):
@@ -9,11 +47,30 @@ class EnseignerTestCase(unittest.TestCase):
         self.db = model.sqlite3.connect(':memory:', )
         with self.db:
             for table in model.tables:
-                table._instances = model.weakref.WeakValueDictionary()
+                table._instances.clear()
                 self.db.execute(table._create_table)
+        migrations.upgrade(self.db)
+        model.subject_catalog.invalidate()
         (self._get_conn, model.get_conn) = (model.get_conn, lambda: self.db)
         emails.MockSender.queue = []
+        # Fast password hashes; see benchmarks/check_password.py for the
+        # cost of real ones.
+        self._config = dict(config)
+        config['password_iterations'] = 1000
     def tearDown(self):
         super(EnseignerTestCase, self).setUp()
         model.get_conn = self._get_conn
+        config.clear()
+        config.update(self._config)
 
+    @contextlib.contextmanager
+    def count_queries(self):
+        """Yields a connection whose `nb_queries` attribute counts the
+        queries run by the model inside the block."""
+        conn = CountingConnection(self.db)
+        get_conn = model.get_conn
+        model.get_conn = lambda: conn
+        try:
+            yield conn
+        finally:
+            model.get_conn = get_conn
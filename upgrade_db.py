@@ -0,0 +1,7 @@
+#!/usr/bin/env python2
+import enseigner.migrations as migrations
+
+applied = migrations.upgrade()
+for name in applied:
+    print('Applied %s' % name)
+print('Schema version: %d' % migrations.current_version())